@@ -0,0 +1,32 @@
+"""
+Times tokenizing long array literals and deeply nested parentheses. Time per
+character should stay flat as inputs grow.
+
+  python -m backend.bench_parser
+"""
+
+import timeit
+
+from backend.parser import tokenize
+
+
+def array_literal(n: int):
+  return '[' + ', '.join(f'a{i % 10} * {i}.5' for i in range(n)) + ']'
+
+
+def nested_parens(n: int):
+  return '(' * n + 'x' + ')' * n
+
+
+def main():
+  for name, build in [('array', array_literal), ('parens', nested_parens)]:
+    for n in (1_000, 10_000, 100_000):
+      text = build(n)
+      runs, total = timeit.Timer(lambda: tokenize(text)).autorange()
+      each = total / runs
+      print(f'{name:6}  n={n:<7}  {len(text):>8} chars  {each * 1e3:8.2f} ms  '
+            f'{each / len(text) * 1e9:6.1f} ns/char')
+
+
+if __name__ == '__main__':
+  main()
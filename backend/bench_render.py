@@ -0,0 +1,285 @@
+"""
+Load tests the render endpoint: concurrent clients post a weighted mix of
+configs built from input/*.stl, and the run reports throughput, time to first
+output, and p50/p95/p99 completion latency overall and per config.
+
+  python -m backend.bench_render [--clients 8] [--requests 200] [--warmup 10]
+                                 [--mix load=1,union=2,...] [--seed 0]
+                                 [--url http://127.0.0.1:5000] [--json]
+
+Drives the app in-process unless given the --url of a server started from the
+repository root (e.g. `main.py --serve`). For runs to be comparable, the
+sequence of configs is fixed by the seed, clients take requests from it in
+turn until a fixed count has completed, and warmup requests (which fill the
+mesh caches) are left out of the results.
+"""
+
+from dataclasses import dataclass, field
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import urllib.parse
+
+RENDER_PATH = '/cgi-bin/render.pl'
+
+# Named configs for the mix, using input meshes that are closed volumes.
+CONFIGS = {
+  'load': {
+    'base': 'input/hook-7-5-2.stl',
+    'save_as': 'load.stl',
+  },
+  'union': {
+    'base': 'input/base-45.stl',
+    'load': 'input/hook-10-5-2.stl',
+    'attach': 'top_center',
+    'save_as': 'union.stl',
+  },
+  'subtract': {
+    'base': 'input/base.stl',
+    'load': 'input/cone.stl',
+    'invert': True,
+    'scale': 0.4,
+    'attach': 'top_center',
+    'translate': [0, -4, 0],
+    'save_as': 'subtract.stl',
+  },
+  'iterate': {
+    'iterate': 4,
+    'base': 'input/base-40-7.stl',
+    'load': 'input/hook-4-4-2.stl',
+    'attach': 'top_center',
+    'translate': [0, 0, {'eval': 'arg0 * 8 - 12'}],
+    'save_as': 'iterate-{arg0}.stl',
+  },
+  'pattern': {
+    'base': 'input/base-45.stl',
+    'load': 'input/wedge.stl',
+    'scale': 0.2,
+    'attach': 'top_center',
+    'translate': [-15, 0, -15],
+    'pattern': {'grid': [4, 1, 4], 'spacing': [9, 0, 9]},
+    'save_as': 'pattern.stl',
+  },
+}
+
+
+@dataclass
+class Sample:
+  """One request's timings, in seconds from when it was sent."""
+  config: str
+  first_output: float|None = None
+  completed: float = 0.0
+  outputs: int = 0
+  errors: list[str] = field(default_factory=list)
+
+
+class _Lines:
+  """Splits a streamed body into json events, timing the first output."""
+  def __init__(self, sample: Sample, started: float):
+    self.sample = sample
+    self.started = started
+    self.partial = b''
+
+  def feed(self, data: bytes):
+    *lines, self.partial = (self.partial + data).split(b'\n')
+    for line in lines:
+      if not line.strip():
+        continue
+      event = json.loads(line)
+      if 'name' in event:
+        if self.sample.first_output is None:
+          self.sample.first_output = time.perf_counter() - self.started
+        self.sample.outputs += 1
+      elif 'error' in event:
+        self.sample.errors.append(event['error'])
+
+
+async def _post_app(app, body: bytes, lines: _Lines):
+  """Runs one request through the app's asgi interface, in this process."""
+  scope = {
+    'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+    'method': 'POST', 'scheme': 'http', 'path': RENDER_PATH,
+    'raw_path': RENDER_PATH.encode(), 'query_string': b'', 'root_path': '',
+    'headers': [(b'host', b'localhost'),
+                (b'content-length', str(len(body)).encode())],
+    'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80), 'extensions': {},
+  }
+  sent = False
+  finished = asyncio.Event()
+
+  async def receive():
+    nonlocal sent
+    if not sent:
+      sent = True
+      return {'type': 'http.request', 'body': body, 'more_body': False}
+    await finished.wait()
+    return {'type': 'http.disconnect'}
+
+  async def send(message):
+    if message['type'] == 'http.response.start' and message['status'] != 200:
+      lines.sample.errors.append(f'HTTP {message["status"]}')
+    elif message['type'] == 'http.response.body':
+      lines.feed(message.get('body', b''))
+
+  try:
+    await app(scope, receive, send)
+  finally:
+    finished.set()
+
+
+async def _post_url(url: str, body: bytes, lines: _Lines):
+  """Posts one request to a server over HTTP/1.1, reading the chunked stream."""
+  parts = urllib.parse.urlsplit(url)
+  reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+  try:
+    writer.write(
+      f'POST {RENDER_PATH} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+      f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    status = int((await reader.readline()).split()[1])
+    if status != 200:
+      lines.sample.errors.append(f'HTTP {status}')
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+      name, _, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip().lower()
+    if headers.get('transfer-encoding') == 'chunked':
+      while size := int((await reader.readline()).split(b';')[0], 16):
+        lines.feed(await reader.readexactly(size))
+        await reader.readline()
+    else:
+      while data := await reader.read(1 << 16):
+        lines.feed(data)
+  finally:
+    writer.close()
+
+
+def _parse_mix(text: str|None) -> dict[str, float]:
+  if not text:
+    return {name: 1.0 for name in CONFIGS}
+  mix = {}
+  for item in text.split(','):
+    name, _, weight = item.partition('=')
+    if name not in CONFIGS:
+      raise SystemExit(
+        f'Unknown config "{name}", expected one of {", ".join(CONFIGS)}')
+    mix[name] = float(weight or 1)
+  return mix
+
+
+def schedule(mix: dict[str, float], count: int, seed: int) -> list[str]:
+  """The configs to request, in order, the same for a given seed."""
+  return random.Random(seed).choices(list(mix), weights=list(mix.values()), k=count)
+
+
+async def run(names: list[str], clients: int,
+              url: str|None = None) -> tuple[list[Sample], float]:
+  """Requests the named configs with `clients` at once, timing each."""
+  if url is None:
+    from backend.web import app
+    post = lambda body, lines: _post_app(app, body, lines)
+  else:
+    post = lambda body, lines: _post_url(url, body, lines)
+  pending = iter(enumerate(names))
+  samples: list[Sample|None] = [None] * len(names)
+
+  async def client():
+    for index, name in pending:
+      sample = Sample(name)
+      started = time.perf_counter()
+      try:
+        await post(json.dumps(CONFIGS[name]).encode(), _Lines(sample, started))
+      except Exception as e:
+        sample.errors.append(f'{e.__class__.__name__}: {e}')
+      sample.completed = time.perf_counter() - started
+      samples[index] = sample
+
+  started = time.perf_counter()
+  await asyncio.gather(*(client() for _ in range(clients)))
+  return samples, time.perf_counter() - started
+
+
+def percentiles(values: list[float]) -> dict[str, float|None]:
+  """p50, p95 and p99 of the values, in milliseconds."""
+  if len(values) < 2:
+    value = values[0] * 1e3 if values else None
+    return {'p50': value, 'p95': value, 'p99': value}
+  cuts = statistics.quantiles(values, n=100, method='inclusive')
+  return {'p50': cuts[49] * 1e3, 'p95': cuts[94] * 1e3, 'p99': cuts[98] * 1e3}
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+  def latencies(samples: list[Sample]):
+    return {
+      'requests': len(samples),
+      'errors': sum(bool(s.errors) for s in samples),
+      'first_output_ms': percentiles(
+        [s.first_output for s in samples if s.first_output is not None]),
+      'completion_ms': percentiles([s.completed for s in samples]),
+    }
+  return dict(
+    latencies(samples),
+    seconds=elapsed,
+    requests_per_second=len(samples) / elapsed,
+    outputs_per_second=sum(s.outputs for s in samples) / elapsed,
+    configs={name: latencies([s for s in samples if s.config == name])
+             for name in sorted({s.config for s in samples})},
+  )
+
+
+def _print_report(report: dict):
+  def row(name: str, stats: dict):
+    first, done = stats['first_output_ms'], stats['completion_ms']
+    cells = [f'{v:8.1f}' if v is not None else f'{"-":>8}'
+             for v in (*first.values(), *done.values())]
+    print(f'{name:10} {stats["requests"]:>6} {stats["errors"]:>6}  {"".join(cells)}')
+
+  run = report['run']
+  print(f'{run["clients"]} clients, {run["requests"]} requests '
+        f'({run["warmup"]} warmup), seed {run["seed"]}, {run["target"]}')
+  print(f'{report["requests_per_second"]:.2f} requests/s, '
+        f'{report["outputs_per_second"]:.2f} outputs/s over {report["seconds"]:.2f}s')
+  print(f'{"":10} {"count":>6} {"errors":>6}  {"first output (ms)":^24}{"completion (ms)":^24}')
+  print(f'{"":10} {"":6} {"":6}  ' + '     p50     p95     p99' * 2)
+  row('all', report)
+  for name, stats in report['configs'].items():
+    row(name, stats)
+
+
+def main(argv: list[str]):
+  as_json = '--json' in argv
+  argv = [arg for arg in argv if arg != '--json']
+  opts = dict(zip(argv[::2], argv[1::2]))
+  clients = int(opts.get('--clients', 8))
+  count = int(opts.get('--requests', 200))
+  mix = _parse_mix(opts.get('--mix'))
+  warmup = int(opts.get('--warmup', 2 * len(mix)))
+  seed = int(opts.get('--seed', 0))
+  url = opts.get('--url')
+  if url is None:
+    # inputs are found relative to the repository root
+    os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+  async def both():
+    # warmup covers each config at least once, before the timed requests
+    await run(sorted(mix) + schedule(mix, warmup, seed + 1), clients, url)
+    return await run(schedule(mix, count, seed), clients, url)
+  samples, elapsed = asyncio.run(both())
+
+  report = summarize(samples, elapsed)
+  report['run'] = dict(
+    clients=clients, requests=count, warmup=warmup, seed=seed, mix=mix,
+    target=url or 'in-process', python=platform.python_version(),
+    cpus=os.cpu_count())
+  if as_json:
+    print(json.dumps(report, indent=2))
+  else:
+    _print_report(report)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
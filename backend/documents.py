@@ -0,0 +1,86 @@
+"""
+Splits a stream of configs into documents as they arrive, so that each can
+start executing before the rest of the input has been read.
+
+Accepts yaml documents separated by `---` (and optionally ended by `...`), or
+newline delimited json with one config per line.
+"""
+
+import codecs
+import json
+import re
+import typing
+
+import yaml
+
+
+DOCUMENT_START = re.compile(r'^---(\s|$)')
+DOCUMENT_END = re.compile(r'^\.\.\.\s*$')
+
+
+class DocumentSplitter:
+  """Incrementally splits text into the source of each document."""
+  def __init__(self):
+    self.partial = ''
+    self.lines: list[str] = []
+
+  def feed(self, text: str) -> list[str]:
+    """Adds text, returning any documents it completed."""
+    *lines, self.partial = (self.partial + text).split('\n')
+    docs = []
+    for line in lines:
+      docs.extend(self._line(line))
+    return docs
+
+  def close(self) -> list[str]:
+    """Returns the remaining document(s) at the end of input."""
+    docs = list(self._line(self.partial)) if self.partial else []
+    self.partial = ''
+    docs.extend(self._flush())
+    return docs
+
+  def _line(self, line: str):
+    if DOCUMENT_START.match(line):
+      yield from self._flush()
+      self.lines.append(line[3:])
+    elif DOCUMENT_END.match(line):
+      yield from self._flush()
+    elif (line.startswith('{') and line.rstrip().endswith('}')
+          and not self._has_content()):
+      # a complete flow mapping, i.e. a line of ndjson
+      yield from self._flush()
+      yield line
+    else:
+      self.lines.append(line)
+
+  def _has_content(self):
+    return any(
+      line.strip() and not line.lstrip().startswith('#') for line in self.lines)
+
+  def _flush(self):
+    if self._has_content():
+      yield '\n'.join(self.lines)
+    self.lines = []
+
+
+def parse_document(text: str):
+  """Parses a document from the splitter, as json where possible."""
+  if text.startswith('{'):
+    try:
+      return json.loads(text)
+    except ValueError:
+      pass
+  return yaml.safe_load(text)
+
+
+async def read_documents(chunks: typing.AsyncIterable[str|bytes]):
+  """Yields the source of each document from a stream of text or utf-8 chunks."""
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  splitter = DocumentSplitter()
+  async for chunk in chunks:
+    if isinstance(chunk, bytes):
+      chunk = decoder.decode(chunk)
+    for doc in splitter.feed(chunk):
+      yield doc
+  for doc in splitter.feed(decoder.decode(b'', final=True)) + splitter.close():
+    yield doc
@@ -3,15 +3,25 @@ Executes logic according to a given data structure.
 """
 
 from dataclasses import dataclass
-import numpy as np
+import collections
+import concurrent.futures
+import contextlib
+import os
+import string
 import typing
 import json
 import asyncio
+import weakref
 
+from backend import metrics
+from backend.lazy import lazy_import
 import backend.parser as parser
-from backend.shape import Shape, Volume
+from backend.shape import Shape, Volume, primitives
 import backend.validators as val
 
+np = lazy_import('numpy')
+aiofiles = lazy_import('aiofiles')
+
 
 class AbortError(Exception):
   pass
@@ -25,21 +35,223 @@ class ExecutorFunction:
   expects: val.Validator
 
 
+class MeshMemory:
+  """
+  Accounts for the bytes held by meshes in live contexts. Over `limit`, the
+  meshes of contexts other than the running one (i.e. parents waiting on
+  their children) are spilled to disk, coldest first, except those kept for
+  being copied again. Without a limit nothing is measured, as that would
+  evaluate every pending boolean.
+  """
+  def __init__(self, limit: int|None = None):
+    self.limit = limit
+    # context => order entered, outer contexts first
+    self.contexts: weakref.WeakKeyDictionary['Context', int] = weakref.WeakKeyDictionary()
+    # contexts about to be used, which spilling would only restore again
+    self.kept: weakref.WeakSet['Context'] = weakref.WeakSet()
+    self.entered = 0
+    self.peak = 0
+    self.spills = 0
+
+  @classmethod
+  def from_env(cls):
+    """Budget from YASE_MEMORY_MB, unlimited when unset."""
+    mb = os.environ.get('YASE_MEMORY_MB')
+    return cls(int(float(mb) * 2**20) if mb else None)
+
+  def enter(self, ctx: 'Context'):
+    if ctx not in self.contexts:
+      self.contexts[ctx] = self.entered
+      self.entered += 1
+
+  @contextlib.contextmanager
+  def keep(self, ctx: 'Context'):
+    """Keeps the context's meshes in memory for the enclosed block."""
+    self.kept.add(ctx)
+    try:
+      yield
+    finally:
+      self.kept.discard(ctx)
+
+  def shapes(self, ctx: 'Context') -> list[Shape]:
+    return [s for s in (ctx.shape, ctx.other) if s is not None]
+
+  def check(self, current: 'Context') -> bool:
+    """
+    Records the bytes held, spilling cold meshes when over budget. Returns
+    True if still over budget once nothing else can be spilled.
+
+    Copies share their manifold or arrays, which are counted once. A mesh
+    shared with another live context isn't spilled, as that frees nothing.
+    """
+    if self.limit is None:
+      return False
+    contexts = sorted(self.contexts.items(), key=lambda item: item[1])
+    held: dict[int, int] = {}
+    holders = collections.Counter()
+    for ctx, _ in contexts:
+      for shape in self.shapes(ctx):
+        buffers = shape.buffers
+        held.update(buffers)
+        holders.update(buffers.keys())
+    total = sum(held.values())
+    self.peak = max(self.peak, total)
+    if total <= self.limit:
+      return False
+    for ctx, _ in contexts:
+      if ctx is current or ctx in self.kept:
+        continue
+      for shape in self.shapes(ctx):
+        buffers = shape.buffers
+        if shape.spilled or all(holders[key] > 1 for key in buffers):
+          continue
+        holders.subtract(buffers.keys())
+        total -= shape.spill()
+        self.spills += 1
+        if total <= self.limit:
+          return False
+    return True
+
+
 class ExecutorEnvironment:
   """How the executor interacts with the system (cli, filesystem, http)"""
-  def print(self, *args):
+  def __init__(self):
+    # mesh fingerprint => first filename saved with that content
+    self.outputs: dict[str, str] = {}
+    # filename => fingerprint of the content it was last saved with
+    self.saved: dict[str, str] = {}
+    self.memory = MeshMemory.from_env()
+    # position parts without running booleans
+    self.preview = False
+
+  async def print(self, *args):
     print(*args)
 
-  def error(self, error: str):
+  async def error(self, error: str):
     print('Error: ', error)
 
-  def get_file(self, filename: str, _: dict):
-    return open(f'output/{filename}', 'wb')
+  def claim(self, filename: str, fingerprint: str) -> str:
+    """
+    Records the filename as saved with the given content, returning an earlier
+    output with the same content to refer to, or the filename if it's new.
+    """
+    stale = self.saved.get(filename)
+    if stale is not None and self.outputs.get(stale) == filename:
+      # written over, so the name no longer holds its earlier content
+      del self.outputs[stale]
+    self.saved[filename] = fingerprint
+    return self.outputs.setdefault(fingerprint, filename)
+
+  async def get_file(self, filename: str, _: dict):
+    @contextlib.asynccontextmanager
+    async def ctx():
+      _unlink_reference(filename)
+      with open(f'output/{filename}', 'wb') as fh:
+        yield fh
+    return ctx()
+
+  async def save(self, ctx: 'Context', filename: str, props: dict):
+    """Encodes the context's shape and writes it out."""
+    async with await self.get_file(filename, props) as fh:
+      ctx.shape.save(filename, fh=fh)
+
+  async def reference(self, ctx: 'Context', filename: str, original: str, _: dict):
+    """Emits a file whose content is identical to a previously saved file."""
+    _symlink_output(filename, original)
+
+  async def fork(self, ctx: 'Context', config: dict):
+    """Runs an independent child context from `iterate` or `branch`."""
+    await ctx.process(config)
+
+  async def relieve(self):
+    """
+    Called when over the memory budget with nothing left to spill, to release
+    memory held outside of contexts (e.g. pending outputs).
+    """
+
+
+def _unlink_reference(filename: str):
+  """Removes an earlier reference by the name, rather than writing through it."""
+  if os.path.islink(f'output/{filename}'):
+    os.remove(f'output/{filename}')
+
+
+def _symlink_output(filename: str, original: str):
+  path = f'output/{filename}'
+  if os.path.lexists(path):
+    os.remove(path)
+  os.symlink(os.path.relpath(f'output/{original}', os.path.dirname(path)), path)
+
+
+class ExecutorEnvCli(ExecutorEnvironment):
+  """
+  Writes outputs from a background task, so encoding and disk I/O for one
+  output overlaps with the geometry of the next. At most `max_pending` outputs
+  are held in memory before `save` waits on the writer.
+  """
+  def __init__(self, max_pending: int = 4,
+               pool: concurrent.futures.Executor|None = None):
+    super().__init__()
+    self.queue: asyncio.Queue[tuple|None] = asyncio.Queue(max_pending)
+    self.writer: asyncio.Task|None = None
+    # encodes outputs, defaulting to the event loop's executor
+    self.pool = pool
+    self.stats = collections.Counter()
+
+  async def error(self, error: str):
+    self.stats['errors'] += 1
+    await super().error(error)
+
+  async def save(self, ctx: 'Context', filename: str, props: dict):
+    await self._put(('save', ctx.shape.copy(), filename, ".".join(ctx.path)))
+
+  async def reference(self, ctx: 'Context', filename: str, original: str, _: dict):
+    await self._put(('reference', original, filename, ".".join(ctx.path)))
+
+  async def _put(self, item: tuple):
+    if self.writer is None:
+      self.writer = asyncio.create_task(self._write())
+    await self.queue.put(item)
+
+  async def relieve(self):
+    # serialize, writing pending outputs before the next is computed
+    await self.queue.join()
+
+  async def _write(self):
+    while (item := await self.queue.get()) is not None:
+      action, subject, filename, path = item
+      try:
+        if action == 'reference':
+          _symlink_output(filename, subject)
+          self.stats['references'] += 1
+          continue
+        data = await asyncio.get_running_loop().run_in_executor(
+          self.pool, subject.encode)
+        _unlink_reference(filename)
+        async with aiofiles.open(f'output/{filename}', 'wb') as fh:
+          await fh.write(data)
+        self.stats['outputs'] += 1
+      except Exception as e:
+        await self.error(f'[{path}] Failed to write {filename}: {e}')
+      finally:
+        self.queue.task_done()
+
+  async def close(self):
+    """Waits for all pending outputs to be written."""
+    if self.writer is not None:
+      await self.queue.put(None)
+      await self.writer
+      self.writer = None
+    self.stats['peak_bytes'] = max(self.stats['peak_bytes'], self.memory.peak)
+    self.stats['spills'] = self.memory.spills
 
 
 executior_env = ExecutorEnvironment()
 
 
+_formatter = string.Formatter()
+
+
 class Context:
   """
   State object for the application.
@@ -47,7 +259,10 @@ class Context:
   def __init__(self, executor: 'Executor', env: ExecutorEnvironment = None):
     self.path = []
     self.args = []
-    self.kwargs = {}
+    # the args as `arg{i}`, which take precedence over keyword variables
+    self.arg_vars = {}
+    # keyword variables, with a frame per child context
+    self.kwargs = collections.ChainMap()
     self.executor = executor
     self.env = env or ExecutorEnvironment()
     self.shape: Shape | None = None
@@ -56,32 +271,76 @@ class Context:
 
   @property
   def kwargs_with_args(self):
-    dic = dict(self.kwargs)
-    dic.update({f'arg{i}': v for i, v in enumerate(self.args)})
-    return dic
+    return self.kwargs.new_child(self.arg_vars)
+
+  def push_arg(self, value):
+    """Adds a value to the stack of args, also visible as `arg{i}`."""
+    self.arg_vars[f'arg{len(self.args)}'] = value
+    self.args.append(value)
+
+  def format(self, text: str):
+    """Formats the string with the stack and keyword variables."""
+    return _formatter.vformat(text, self.args, self.kwargs_with_args)
 
   def copy(self):
-    ctx = Context(self.executor.copy())
+    ctx = Context(self.executor.copy(), env=self.env)
     ctx.path = self.path[:]
     ctx.args = self.args[:]
-    ctx.kwargs = dict(self.kwargs)
+    ctx.arg_vars = dict(self.arg_vars)
+    ctx.kwargs = self.kwargs.new_child()
     ctx.shape = None if self.shape is None else self.shape.copy()
     ctx.other = None if self.other is None else self.other.copy()
     ctx.volume = self.volume
-    ctx.env = self.env
     return ctx
   
+  def to_state(self):
+    """A picklable snapshot of the context, without executor or environment."""
+    return dict(
+      path=self.path[:],
+      args=self.args[:],
+      kwargs=dict(self.kwargs),
+      shape=None if self.shape is None else self.shape.to_state(),
+      other=None if self.other is None else self.other.to_state(),
+      volume=self.volume,
+    )
+
+  @classmethod
+  def from_state(cls, executor: 'Executor', state: dict,
+                 env: ExecutorEnvironment = None):
+    ctx = Context(executor, env=env)
+    ctx.path = state['path'][:]
+    ctx.args = state['args'][:]
+    ctx.arg_vars = {f'arg{i}': arg for i, arg in enumerate(ctx.args)}
+    ctx.kwargs = collections.ChainMap(dict(state['kwargs']))
+    ctx.shape = None if state['shape'] is None else Shape.from_state(state['shape'])
+    ctx.other = None if state['other'] is None else Shape.from_state(state['other'])
+    ctx.volume = state['volume']
+    return ctx
+
   async def process(self, config: dict|None=None):
     await self.executor.process(self, config)
   
   def merge(self):
-    self.shape.merge(self.other)
+    if self.other is None:
+      return
+    if self.env.preview:
+      self.shape.combine(self.other)
+    elif self.other.inverted:
+      self.shape.subtract(self.other)
+    else:
+      self.shape.merge(self.other)
     self.other = None
 
   async def save(self, filename):
+    if self.shape.is_empty:
+      await self.error(f'Not saving {filename}, as the mesh is empty')
+      return
     props = {'volume': self.volume.to_dict()}
-    async with await self.env.get_file(filename, props) as fh:
-      self.shape.save(filename, fh=fh)
+    original = self.env.claim(filename, self.shape.fingerprint())
+    if original != filename:
+      await self.env.reference(self, filename, original, props)
+      return
+    await self.env.save(self, filename, props)
 
   async def print(self, *args):
     if len(args) == 1 and isinstance(args[0], str):
@@ -135,6 +394,7 @@ class Executor():
       print(config)
       raise e
     self.config = config
+    ctx.env.memory.enter(ctx)
 
     missing = [k for k in config.keys() if k not in self.map]
     if missing:
@@ -146,13 +406,16 @@ class Executor():
          continue
        ctx.path.append(name)
        value = config[name]
+       if ctx.env.memory.check(ctx):
+         await ctx.env.relieve()
        try:
         if self.map[name].expects != val.commands:
           if isinstance(value, (dict, list)):
             cp = json.loads(json.dumps(value))
             value = self.evaluate(cp, ctx.kwargs_with_args)
         del config[name]
-        await (self.map[name].func)(value, ctx)
+        with metrics.command_seconds.labels(name).time():
+          await (self.map[name].func)(value, ctx)
        except val.ValidationError as e:
          await ctx.print(e.msg)
          raise AbortError()
@@ -219,29 +482,49 @@ async def iterate(args: list, ctx: Context):
   If given a list of key/value pairs (a dictionary or map), each iteration
   will have the set of keys and their values added to the context's keyword
   variables.
+
+  Commands that don't refer to the iteration's variables, such as loading the
+  base, run once before iterating rather than for every iteration.
   """
   if type(args) != list:
     args = [args]
   config = ctx.executor.config
-  if type(args) == list:
-    if type(args[0]) == int:
-      for i in range(*args):
-        cpy = ctx.copy()
-        cpy.path.append(f'{i}')
-        cpy.args.append(i)
-        await cpy.process(config)
-    elif type(args[0]) == dict:
-      for i, kwargs in enumerate(args):
-        cpy = ctx.copy()
-        cpy.path.append(f'{i}')
-        cpy.kwargs.update(kwargs)
-        await cpy.process(config)
-    else:
-      for i, item in enumerate(args):
-        cpy = ctx.copy()
-        cpy.path.append(f'{i}')
-        cpy.args.append(item)
-        await cpy.process(config)
+  if type(args[0]) == int:
+    # labelled by the value itself
+    items = [(f'{i}', i) for i in range(*args)]
+  else:
+    items = [(f'{i}', item) for i, item in enumerate(args)]
+  if type(args[0]) == dict:
+    names = {key for _, kwargs in items for key in kwargs}
+  else:
+    names = {f'arg{len(ctx.args)}'}
+
+  # run what doesn't vary between iterations once, in a copy, so that the
+  # iterations start from its result (and this context is left as it was)
+  shared = ctx
+  hoisted, repeated = split_invariant(config, names)
+  if items and hoisted:
+    shared = ctx.copy()
+    shared.env = held = ExecutorEnvHeld(ctx.env)
+    try:
+      await shared.process(hoisted)
+    except Exception:
+      held.failed = True
+    shared.env = ctx.env
+    if held.failed:
+      # run it all for each iteration instead, which reports failures with
+      # the iteration's path
+      shared, repeated = ctx, dict(config)
+
+  with ctx.env.memory.keep(shared):
+    for label, item in items:
+      cpy = shared.copy()
+      cpy.path.append(label)
+      if type(item) == dict:
+        cpy.kwargs.update(item)
+      else:
+        cpy.push_arg(item)
+      await ctx.env.fork(cpy, repeated)
   config.clear()
 
 
@@ -258,7 +541,7 @@ async def var(kwargs: dict, ctx: Context):
 async def print_(message, ctx: Context):
   """Prints the given argument"""
   if isinstance(message, str) and '{' in message:
-    message = message.format(*ctx.args, **ctx.kwargs_with_args)
+    message = ctx.format(message)
   await ctx.print(message)
 
 
@@ -266,7 +549,7 @@ async def print_(message, ctx: Context):
 async def error(message, ctx: Context):
   """Prints the given argument as an error message"""
   if isinstance(message, str) and '{' in message:
-    message = message.format(*ctx.args, **ctx.kwargs_with_args)
+    message = ctx.format(message)
   await ctx.error(message)
 
 
@@ -275,48 +558,78 @@ async def sleep(how_long: float, ctx: Context):
   await asyncio.sleep(how_long)
 
 
-@executor.wrap(expected=val.string)
-async def base(filename: str, ctx: Context):
-  """Load an stl into the subject position."""
-  ctx.shape = Shape.load(
-    filename.format(*ctx.args, **ctx.kwargs_with_args))
+shape_input = val.or_(
+  val.string, val.mesh_file, val.primitive(primitives.keys()))
+
+
+def _load_shape(spec: str|dict, ctx: Context):
+  """Loads a mesh file (optionally simplified), or generates a primitive."""
+  if isinstance(spec, dict) and 'file' in spec:
+    return Shape.load(
+      ctx.format(spec['file']), faces=spec.get('faces'),
+      tolerance=spec.get('tolerance'))
+  if isinstance(spec, dict):
+    [kind] = [k for k in spec.keys() if k != 'segments']
+    return Shape.primitive(kind, spec[kind], spec.get('segments'))
+  return Shape.load(ctx.format(spec))
+
+
+@executor.wrap(expected=shape_input)
+async def base(spec: str|dict, ctx: Context):
+  """
+  Load an stl into the subject position.
+
+  Instead of a filename, accepts a primitive of the given [x, y, z] size, such
+  as `{box: [20, 20, 20]}` or `{cylinder: [4, 4, 10], segments: 32}`. Supported
+  primitives are box, cylinder, cone and wedge.
+
+  Finely tessellated files can be simplified as they are loaded, to at most a
+  number of faces, as in `{file: part.stl, faces: 2000}`, or moving surfaces by
+  at most a tolerance, as in `{file: part.stl, tolerance: 0.05}`. Either stops
+  short of distorting the mesh, so a budget may be left unmet.
+  """
+  ctx.shape = _load_shape(spec, ctx)
   ctx.shape.zero()
   ctx.volume = ctx.shape.volume
 
 
-@executor.wrap(expected=val.string)
-async def load(filename: str, ctx: Context):
-  """Load an stl into the object posiiton."""
+@executor.wrap(expected=shape_input)
+async def load(spec: str|dict, ctx: Context):
+  """
+  Load an stl into the object posiiton.
+
+  Accepts primitives in the same format as `base`.
+  """
   if ctx.other is not None:
     ctx.merge()
-  ctx.other = Shape.load(
-    filename.format(*ctx.args, **ctx.kwargs_with_args))
+  ctx.other = _load_shape(spec, ctx)
   ctx.other.zero()
 
 
 @executor.wrap(expected=val.any_)
 async def invert(_: any, ctx: Context):
+  """Marks the object to be subtracted from the subject, rather than added."""
   ctx.other.invert()
 
 
 @executor.wrap(expected=val.numeric)
 async def rotate_x(degrees: float, ctx: Context):
   """Rotates around the x axis in degrees"""
-  ctx.other.mesh.rotate([0.5, 0, 0], np.radians(degrees))
+  ctx.other.rotate([1, 0, 0], degrees)
   ctx.other.zero()
 
 
 @executor.wrap(expected=val.numeric)
 async def rotate_y(degrees: float, ctx: Context):
   """Rotates around the y axis in degrees"""
-  ctx.other.mesh.rotate([0, 0.5, 0], np.radians(degrees))
+  ctx.other.rotate([0, 1, 0], degrees)
   ctx.other.zero()
 
 
 @executor.wrap(expected=val.numeric)
 async def rotate_z(degrees: float, ctx: Context):
   """Rotates around the z axis in degrees"""
-  ctx.other.mesh.rotate([0, 0, 0.5], np.radians(degrees))
+  ctx.other.rotate([0, 0, 1], degrees)
   ctx.other.zero()
 
 
@@ -394,6 +707,27 @@ async def attach(style: str, ctx: Context):
   ctx.other.translate(*offset)
 
 
+@executor.wrap(expected=val.pattern_input)
+async def pattern(spec: list[list[float]]|list[list[list[float]]]|dict,
+                  ctx: Context):
+  """
+  Replaces the object with an array of copies of itself, merged into the base
+  with a single boolean.
+
+  Accepts either a list of [x, y, z] offsets, a list of 4x4 transform
+  matrices (rows, applied about the origin), or a map with "grid" counts and
+  "spacing" along each axis, e.g. `{grid: [3, 1, 1], spacing: [5, 0, 0]}`.
+  Offsets are relative to the object's current position. Instances that
+  overlap or touch one another are unioned first, which is slower.
+  """
+  if isinstance(spec, dict):
+    axes = [np.arange(n) * float(d) for n, d in zip(spec['grid'], spec['spacing'])]
+    offsets = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+  else:
+    offsets = np.array(spec, dtype=np.float64)
+  ctx.other = ctx.other.pattern(offsets)
+
+
 @executor.wrap(expected=val.any_)
 async def rebase(_, ctx: Context):
   """Merges the shapes and recalculates the working volume."""
@@ -408,7 +742,7 @@ async def save_as(filename: str, ctx: Context):
   expecting stack and keyword arguments.
   """
   await rebase(None, ctx)
-  await ctx.save(filename.format(*ctx.args, **ctx.kwargs_with_args))
+  await ctx.save(ctx.format(filename))
 
 
 def _normalize_configs(configs: list[dict]|dict):
@@ -425,10 +759,11 @@ async def branch(configs: list[dict], ctx: Context):
   Specify parellel execution paths, each with their own copy of the context.
   """
   configs = _normalize_configs(configs)
-  for i, cfg in enumerate(configs):
-    cpy = ctx.copy()
-    cpy.path.append(f'{i}')
-    await cpy.process(cfg)
+  with ctx.env.memory.keep(ctx):
+    for i, cfg in enumerate(configs):
+      cpy = ctx.copy()
+      cpy.path.append(f'{i}')
+      await ctx.env.fork(cpy, cfg)
 
 
 @executor.wrap(expected=val.commands)
@@ -457,3 +792,149 @@ async def with_(configs: list[dict]|dict, ctx: Context):
     await cpy.process(cfg)
     cpy.path.pop()
   ctx.other = cpy.shape
+
+
+def count_outputs(config: list[dict]|dict) -> int|None:
+  """
+  Counts the outputs a config will save, following `iterate`, `branch`, `then`
+  and `with`. Returns None if a count depends on an evaluated expression.
+  """
+  if isinstance(config, list):
+    counts = [count_outputs(c) for c in config]
+    return None if None in counts else sum(counts)
+  if not isinstance(config, dict):
+    return 0
+  if 'iterate' in config:
+    args = config['iterate']
+    if type(args) != list:
+      args = [args]
+    if not args or any(isinstance(a, dict) and 'eval' in a for a in args):
+      return None
+    iterations = len(range(*args)) if type(args[0]) == int else len(args)
+    rest = count_outputs({k: v for k, v in config.items() if k != 'iterate'})
+    return None if rest is None else iterations * rest
+  count = 1 if 'save_as' in config else 0
+  for name in ('branch', 'then', 'with'):
+    if name in config:
+      if isinstance(config[name], dict) and 'eval' in config[name]:
+        return None
+      nested = count_outputs(config[name])
+      if nested is None:
+        return None
+      count += nested
+  return count
+
+
+# Commands that only change the context's shapes, volume or variables, so they
+# can run once ahead of an `iterate` when not referring to its variables.
+HOISTABLE = {
+  'var', 'base', 'load', 'invert', 'rotate_x', 'rotate_y', 'rotate_z',
+  'scale', 'set_size', 'offset', 'translate', 'attach', 'pattern', 'rebase',
+}
+# Commands that leave the context alone, so later commands can still be hoisted
+# past them (while they repeat for every iteration).
+PASSIVE = {'print', 'error', 'sleep'}
+
+
+class ExecutorEnvHeld(ExecutorEnvironment):
+  """
+  Runs the commands hoisted out of an `iterate`, sharing the environment's
+  state. Hoistable commands only print on failure, so rather than printing
+  (without an iteration in the path) this marks the hoisting as failed.
+  """
+  def __init__(self, env: ExecutorEnvironment):
+    super().__init__()
+    self.outputs = env.outputs
+    self.saved = env.saved
+    self.memory = env.memory
+    self.preview = env.preview
+    self.env = env
+    self.failed = False
+
+  async def print(self, *args):
+    self.failed = True
+
+  async def error(self, error: str):
+    self.failed = True
+
+  async def relieve(self):
+    await self.env.relieve()
+
+
+def references(value, expression: bool = False) -> set[str]|None:
+  """
+  Names of the variables a command's value refers to, through `eval`
+  expressions or format strings, with positional fields as their `arg{i}`
+  names. Returns None when unknown, e.g. for an expression that won't parse.
+  """
+  names = set()
+  if isinstance(value, str):
+    if expression:
+      try:
+        return parser.variables(value)
+      except AssertionError:
+        return None
+    try:
+      fields = [(f, spec) for _, f, spec, _ in _formatter.parse(value) if f is not None]
+    except ValueError:
+      return None
+    auto = 0
+    for field, spec in fields:
+      name = field.split('.')[0].split('[')[0]
+      if name == '':
+        name, auto = f'arg{auto}', auto + 1
+      elif name.isdigit():
+        name = f'arg{name}'
+      names.add(name)
+      # a spec may itself have fields, e.g. "{0:{width}}"
+      nested = references(spec)
+      if nested is None:
+        return None
+      names |= nested
+    return names
+  if isinstance(value, dict):
+    if 'eval' in value and not expression:
+      parts, expression = [value['eval'], value.get('else')], True
+    else:
+      parts = list(value.values())
+  elif isinstance(value, list):
+    parts = value
+  else:
+    return names
+  for part in parts:
+    nested = references(part, expression)
+    if nested is None:
+      return None
+    names |= nested
+  return names
+
+
+def split_invariant(config: dict, names: set[str]) -> tuple[dict, dict]:
+  """
+  Splits the commands following an `iterate` into those that can run once
+  beforehand, being unaffected by the iteration variables `names`, and those
+  that must run for each iteration.
+
+  Commands run in their declared order, so only a leading run of hoistable
+  commands (skipping passive ones) can be hoisted. Variables set by a `var`
+  that repeats are themselves treated as iteration variables, so it only holds
+  back the commands referring to them.
+  """
+  names = set(names)
+  hoisted, repeated = {}, {}
+  for name in executor.index:
+    if name not in config:
+      continue
+    value = config[name]
+    refs = references(value)
+    invariant = refs is not None and not refs & names
+    if name == 'var':
+      invariant = invariant and isinstance(value, dict) and not names & value.keys()
+    # a repeated `var` only stops hoisting of what refers to its variables
+    if not repeated.keys() - PASSIVE - {'var'} and name in HOISTABLE and invariant:
+      hoisted[name] = value
+      continue
+    repeated[name] = value
+    if name == 'var' and isinstance(value, dict):
+      names |= value.keys()
+  return hoisted, repeated
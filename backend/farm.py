@@ -0,0 +1,308 @@
+"""
+Splits a config across worker processes, which may run on other hosts.
+
+The coordinator runs the config with an environment that, rather than running
+the children of `iterate` and `branch`, packages each one as a job: a context
+snapshot plus the config it would have processed. Jobs whose config contains
+no further `iterate` or `branch` are sent to workers, which connect over a
+local socket, run the job and return its prints, errors and encoded outputs.
+What the coordinator emits itself (e.g. from a `then` after a `branch`) is
+numbered in between the jobs, and everything is replayed in that order through
+the caller's environment, so the output matches a sequential run.
+
+Job meshes are held in shared memory (see `backend.transport`), so workers
+on the same host receive handles rather than copies; workers connecting from
+other hosts are sent the arrays.
+"""
+
+from dataclasses import dataclass, field, replace
+from multiprocessing.connection import Client, Listener
+import asyncio
+import hashlib
+import ipaddress
+import os
+import queue
+import subprocess
+import sys
+import threading
+import typing
+
+from backend.executor import AbortError, Context, ExecutorEnvironment, executor
+from backend.transport import SharedMeshes, attach
+
+
+AUTHKEY_ENV = 'YASE_FARM_AUTHKEY'
+MAX_ATTEMPTS = 3
+
+
+@dataclass
+class Job:
+  index: int
+  state: dict
+  config: dict
+  attempts: int = 0
+
+
+@dataclass
+class Result:
+  index: int
+  # ('print', msg), ('error', msg), ('save', filename, data, path),
+  # or ('reference', filename, original, path)
+  events: list[tuple] = field(default_factory=list)
+
+
+def _forks(config) -> bool:
+  """Whether the config contains any further `iterate` or `branch`."""
+  if isinstance(config, dict):
+    return (
+      'iterate' in config or 'branch' in config
+      or any(_forks(v) for v in config.values()))
+  if isinstance(config, list):
+    return any(_forks(v) for v in config)
+  return False
+
+
+class ExecutorEnvCollect(ExecutorEnvironment):
+  """Records everything a job emits, to be returned to the coordinator."""
+  def __init__(self):
+    super().__init__()
+    self.events: list[tuple] = []
+
+  def record(self, event: tuple):
+    self.events.append(event)
+
+  async def print(self, *args):
+    self.record(('print', ' '.join(str(arg) for arg in args)))
+
+  async def error(self, error: str):
+    self.record(('error', error))
+
+  async def save(self, ctx: Context, filename: str, _: dict):
+    self.record(('save', filename, ctx.shape.encode(), ctx.path[:]))
+
+  async def reference(self, ctx: Context, filename: str, original: str, _: dict):
+    self.record(('reference', filename, original, ctx.path[:]))
+
+
+class ExecutorEnvCoordinator(ExecutorEnvCollect):
+  """
+  Expands a config into jobs, passing each to `submit`. Given `meshes`, job
+  shapes are moved into shared memory. Events from the coordinator's own
+  contexts are kept in `local`, as results numbered in sequence with the jobs.
+  """
+  def __init__(self, submit: typing.Callable[[Job], None],
+               meshes: SharedMeshes|None = None):
+    super().__init__()
+    self.submit = submit
+    self.meshes = meshes
+    self.count = 0
+    self.local: dict[int, Result] = {}
+
+  def record(self, event: tuple):
+    if self.count - 1 not in self.local:
+      self.local[self.count] = Result(self.count)
+      self.count += 1
+    self.local[self.count - 1].events.append(event)
+
+  async def fork(self, ctx: Context, config: dict):
+    if _forks(config):
+      await ctx.process(config)
+      return
+    state = ctx.to_state()
+    if self.meshes is not None:
+      state = self.meshes.share(self.count, state)
+    self.submit(Job(self.count, state, dict(config)))
+    self.count += 1
+
+
+async def run_job(job: Job) -> Result:
+  env = ExecutorEnvCollect()
+  ctx = Context.from_state(executor, attach(job.state), env=env)
+  try:
+    await ctx.process(job.config)
+  except AbortError:
+    pass
+  except Exception as e:
+    await ctx.error(f'Unhandled {e.__class__.__name__}: {e}')
+  return Result(job.index, env.events)
+
+
+def work(address: tuple[str, int], authkey: bytes):
+  """Pulls jobs from the coordinator until told to stop."""
+  with Client(address, authkey=authkey) as conn:
+    while (job := conn.recv()) is not None:
+      conn.send(asyncio.run(run_job(job)))
+
+
+class Coordinator:
+  """
+  Hands jobs to connected workers, requeueing a job when its worker's
+  connection drops or, given a `timeout`, when it takes longer than that many
+  seconds. Local workers that die are replaced while jobs remain, and queued
+  jobs fail once every local worker has exited with none connected.
+  """
+  def __init__(self, address: tuple[str, int] = ('127.0.0.1', 0),
+               workers: int = os.cpu_count() or 1, authkey: bytes|None = None,
+               timeout: float|None = None):
+    self.authkey = authkey or os.urandom(16)
+    self.listener = Listener(address, authkey=self.authkey)
+    self.workers = workers
+    self.timeout = timeout
+    # workers with an open connection
+    self.connected = 0
+    self.lock = threading.Lock()
+    self.jobs = queue.Queue[Job]()
+    self.results = queue.Queue[Result]()
+    self.done = threading.Event()
+    self.processes: list[subprocess.Popen] = []
+    self.meshes = SharedMeshes()
+
+  @property
+  def address(self) -> tuple[str, int]:
+    return self.listener.address
+
+  def spawn(self):
+    env = dict(os.environ, **{AUTHKEY_ENV: self.authkey.hex()})
+    main = os.path.join(os.path.dirname(__file__), '..', 'main.py')
+    host, port = self.address
+    self.processes.append(subprocess.Popen(
+      [sys.executable, main, '--worker', f'{host}:{port}'], env=env))
+
+  def _accept(self):
+    while not self.done.is_set():
+      try:
+        conn = self.listener.accept()
+      except OSError:
+        return
+      host = self.listener.last_accepted[0]
+      local = ipaddress.ip_address(host).is_loopback
+      threading.Thread(
+        target=self._serve, args=(conn, local), daemon=True).start()
+
+  def _serve(self, conn, local: bool):
+    with self.lock:
+      self.connected += 1
+    try:
+      with conn:
+        self._send_jobs(conn, local)
+    finally:
+      with self.lock:
+        self.connected -= 1
+
+  def _send_jobs(self, conn, local: bool):
+    while not self.done.is_set():
+      try:
+        job = self.jobs.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      try:
+        conn.send(job if local else replace(
+          job, state=self.meshes.inline(job.state)))
+        if not conn.poll(self.timeout):
+          raise TimeoutError(f'No result after {self.timeout}s')
+        result = conn.recv()
+      except (EOFError, OSError) as e:
+        self._retry(job, e)
+        return
+      self.results.put(result)
+    try:
+      conn.send(None)
+    except OSError:
+      pass
+
+  def _retry(self, job: Job, e: Exception):
+    job.attempts += 1
+    if job.attempts >= MAX_ATTEMPTS:
+      self.results.put(Result(job.index, [(
+        'error', f'Job {job.index} failed after {job.attempts} attempts: {e!r}')]))
+      return
+    self.jobs.put(job)
+    if self.processes:
+      self.spawn()
+
+  def _check_workers(self):
+    """Fails the queued jobs when no local worker is left to run them."""
+    with self.lock:
+      if self.connected or not self.processes or any(
+          process.poll() is None for process in self.processes):
+        return
+    while True:
+      try:
+        job = self.jobs.get_nowait()
+      except queue.Empty:
+        return
+      self.results.put(Result(job.index, [(
+        'error', f'Job {job.index} failed: every worker has exited')]))
+
+  def run(self, config: dict, env: ExecutorEnvironment|None = None):
+    """
+    Expands the config into jobs, then replays their results in order through
+    `env` (by default printing and writing to output/).
+    """
+    env = env or ExecutorEnvironment()
+    threading.Thread(target=self._accept, daemon=True).start()
+    for _ in range(self.workers):
+      self.spawn()
+    coordinator = ExecutorEnvCoordinator(self.jobs.put, self.meshes)
+    try:
+      asyncio.run(Context(executor, env=coordinator).process(config))
+    except AbortError:
+      pass
+
+    pending: dict[int, Result] = dict(coordinator.local)
+    for index in range(coordinator.count):
+      while index not in pending:
+        try:
+          result = self.results.get(timeout=0.1)
+        except queue.Empty:
+          self._check_workers()
+          continue
+        self.meshes.release(result.index)
+        pending[result.index] = result
+      asyncio.run(_replay(pending.pop(index), env))
+    self.close()
+
+  def close(self):
+    self.done.set()
+    self.listener.close()
+    for process in self.processes:
+      try:
+        process.wait(timeout=5)
+      except subprocess.TimeoutExpired:
+        # still busy with a job given up on
+        process.kill()
+        process.wait()
+    self.meshes.close()
+
+
+async def _replay(result: Result, env: ExecutorEnvironment):
+  """
+  Emits a result's events through the environment. Outputs are deduplicated
+  again across results, so references name the output holding their content.
+  """
+  for event in result.events:
+    if event[0] == 'print':
+      await env.print(event[1])
+      continue
+    if event[0] == 'error':
+      await env.error(event[1])
+      continue
+    # the context that saved the output, for the environment to report
+    ctx = Context(executor, env=env)
+    ctx.path = event[3]
+    if event[0] == 'save':
+      _, filename, data, _ = event
+      original = env.claim(filename, hashlib.sha256(data).hexdigest())
+      if original == filename:
+        async with await env.get_file(filename, {}) as fh:
+          fh.write(data)
+        continue
+    else:
+      _, filename, original, _ = event
+      fingerprint = env.saved.get(original)
+      if fingerprint in env.outputs:
+        original = env.claim(filename, fingerprint)
+      if original == filename:
+        # already holds this content
+        continue
+    await env.reference(ctx, filename, original, {})
@@ -0,0 +1,27 @@
+"""
+Defers importing heavy dependencies (numpy, trimesh) until first used, so
+that help, validation and server boot don't pay for the geometry stack.
+"""
+
+import importlib
+import types
+
+
+class LazyModule:
+  """Stands in for a module, importing it on first attribute access."""
+  def __init__(self, name: str):
+    self._name = name
+    self._module: types.ModuleType|None = None
+
+  def __getattr__(self, attr: str):
+    if self._module is None:
+      self._module = importlib.import_module(self._name)
+    return getattr(self._module, attr)
+
+  def __repr__(self):
+    state = 'loaded' if self._module is not None else 'not loaded'
+    return f'<LazyModule {self._name!r} ({state})>'
+
+
+def lazy_import(name: str):
+  return LazyModule(name)
@@ -0,0 +1,275 @@
+"""
+Counters, gauges and histograms for the server's `/metrics` endpoint, in the
+Prometheus text format.
+
+Recording is a dictionary lookup (once per label set) and a locked addition,
+so metrics are always collected. Values are per process, so server workers
+dump theirs to a shared directory for the scraped worker to sum.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+import typing
+
+
+# Seconds, from a millisecond to a minute.
+DEFAULT_BUCKETS = (
+  .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format(value: float) -> str:
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value: str) -> str:
+  return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(pairs: list[tuple[str, str]]) -> str:
+  if not pairs:
+    return ''
+  return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Registry:
+  """The metrics to expose, in the order registered."""
+  def __init__(self):
+    self.metrics: list['Metric'] = []
+
+  def register(self, metric: 'Metric'):
+    self.metrics.append(metric)
+
+  def snapshot(self) -> dict[str, list]:
+    """The current values, as json: metric name => [[label values, value]]."""
+    return {m.name: [[list(k), v] for k, v in m.values().items()]
+            for m in self.metrics}
+
+  def dump(self, directory: str):
+    """Writes this process's snapshot, for whichever process is scraped."""
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+      json.dump(self.snapshot(), fh)
+    os.replace(tmp, os.path.join(directory, f'{os.getpid()}.json'))
+
+  def gather(self, directory: str) -> list[dict[str, list]]:
+    """
+    The snapshots dumped by every process, leaving out the gauges of those
+    which have since exited (their counts still stand).
+    """
+    gauges = {m.name for m in self.metrics if m.kind == 'gauge'}
+    snapshots = []
+    for entry in os.scandir(directory):
+      name, ext = os.path.splitext(entry.name)
+      if ext != '.json' or not name.isdigit():
+        continue
+      try:
+        with open(entry.path) as fh:
+          snapshot = json.load(fh)
+      except (OSError, ValueError):
+        continue
+      if not _alive(int(name)):
+        snapshot = {k: v for k, v in snapshot.items() if k not in gauges}
+      snapshots.append(snapshot)
+    return snapshots
+
+  def render(self, snapshots: list[dict[str, list]]|None = None) -> str:
+    """The exposition of this process's values, or the sum of `snapshots`."""
+    if snapshots is None:
+      snapshots = [self.snapshot()]
+    lines = []
+    for metric in self.metrics:
+      merged = {}
+      for snapshot in snapshots:
+        for labels, value in snapshot.get(metric.name, []):
+          labels = tuple(labels)
+          merged[labels] = value if labels not in merged else (
+            metric.add(merged[labels], value))
+      lines.append(f'# HELP {metric.name} {metric.doc}')
+      lines.append(f'# TYPE {metric.name} {metric.kind}')
+      for labels, value in merged.items():
+        lines.extend(metric.samples(list(zip(metric.label_names, labels)), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+registry = Registry()
+
+
+class Metric:
+  """A family of values, with a child per combination of label values."""
+  kind = ''
+
+  def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (),
+               registry: Registry|None = registry):
+    self.name = name
+    self.doc = doc
+    self.label_names = labels
+    self.lock = threading.Lock()
+    self.children: dict[tuple[str, ...], Metric] = {}
+    if registry is not None:
+      registry.register(self)
+
+  def labels(self, *values: str) -> 'Metric':
+    """The child for the given label values, created on first use."""
+    child = self.children.get(values)
+    if child is None:
+      assert len(values) == len(self.label_names), \
+        f'{self.name} expects labels {self.label_names}'
+      with self.lock:
+        child = self.children.setdefault(values, self._child())
+    return child
+
+  def _child(self) -> 'Metric':
+    return type(self)(self.name, self.doc, registry=None)
+
+  def values(self) -> dict[tuple[str, ...], typing.Any]:
+    """Label values => value, for each child (or just this, unlabelled)."""
+    if not self.label_names:
+      return {(): self.value()}
+    return {k: child.value() for k, child in list(self.children.items())}
+
+  def value(self):
+    raise NotImplementedError()
+
+  def add(self, a, b):
+    """Combines the values of two processes."""
+    raise NotImplementedError()
+
+  def samples(self, labels: list[tuple[str, str]], value) -> list[str]:
+    raise NotImplementedError()
+
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.count = 0.0
+
+  def inc(self, amount: float = 1):
+    with self.lock:
+      self.count += amount
+
+  def value(self):
+    return self.count
+
+  def add(self, a, b):
+    return a + b
+
+  def samples(self, labels, value):
+    return [f'{self.name}{_labels(labels)} {_format(value)}']
+
+
+class Gauge(Counter):
+  kind = 'gauge'
+
+  def dec(self, amount: float = 1):
+    self.inc(-amount)
+
+  @contextlib.contextmanager
+  def track(self):
+    """Counts the enclosed block while it runs."""
+    self.inc()
+    try:
+      yield
+    finally:
+      self.dec()
+
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (),
+               registry: Registry|None = registry,
+               buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    super().__init__(name, doc, labels, registry)
+    # per bucket, with the last for values over every bound
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+
+  def _child(self):
+    return Histogram(self.name, self.doc, registry=None, buckets=self.buckets)
+
+  def observe(self, value: float):
+    index = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[index] += 1
+      self.sum += value
+
+  @contextlib.contextmanager
+  def time(self):
+    """Observes the seconds taken by the enclosed block."""
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - started)
+
+  def value(self):
+    with self.lock:
+      return [self.counts[:], self.sum]
+
+  def add(self, a, b):
+    return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+  def samples(self, labels, value):
+    counts, total = value
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*self.buckets, float('inf')), counts):
+      cumulative += count
+      le = _labels(labels + [('le', _format(bound))])
+      lines.append(f'{self.name}_bucket{le} {cumulative}')
+    lines.append(f'{self.name}_sum{_labels(labels)} {_format(total)}')
+    lines.append(f'{self.name}_count{_labels(labels)} {cumulative}')
+    return lines
+
+
+render_requests = Counter(
+  'yase_render_requests_total', 'Render requests, by route and status.',
+  ('route', 'status'))
+render_seconds = Histogram(
+  'yase_render_duration_seconds',
+  'Seconds from a render request until its stream ended, by route.',
+  ('route',))
+renders_in_flight = Gauge(
+  'yase_renders_in_flight', 'Render requests being processed, by route.',
+  ('route',))
+outputs_queued = Gauge(
+  'yase_outputs_queued', 'Outputs rendered and waiting to be encoded and sent.')
+streamed_bytes = Counter(
+  'yase_streamed_bytes_total', 'Bytes of render responses streamed, by route.',
+  ('route',))
+command_seconds = Histogram(
+  'yase_command_duration_seconds',
+  'Seconds taken by config commands, including their nested blocks.',
+  ('command',))
+boolean_seconds = Histogram(
+  'yase_boolean_duration_seconds',
+  'Seconds taken by mesh booleans, by operation, including evaluating their '
+  'operands.',
+  ('operation',))
+evaluation_seconds = Histogram(
+  'yase_mesh_evaluation_duration_seconds',
+  'Seconds taken turning manifolds (with any deferred transforms) into meshes.')
+cache_requests = Counter(
+  'yase_cache_requests_total', 'Cache lookups, by cache and result.',
+  ('cache', 'result'))
@@ -8,25 +8,45 @@ for more controls over the processing.
 import re
 import json
 
+from backend import metrics
+
+_cache_hits = metrics.cache_requests.labels('parser', 'hit')
+_cache_misses = metrics.cache_requests.labels('parser', 'miss')
+
 class TokenCache:
   def __init__(self):
     self.cache = {}
 
   def get(self, input: str):
-    return self.cache.get(input)
+    token = self.cache.get(input)
+    (_cache_misses if token is None else _cache_hits).inc()
+    return token
   
   def set(self, input: str, token: 'Token'):
     self.cache[input] = token
 
 global_cache = TokenCache()
 
-def parse(input: str, kwargs: dict, cache: TokenCache|None=global_cache):
+def _tokens(input: str, cache: TokenCache|None):
   token = None if cache is None else cache.get(input)
   if token is None:
     token = tokenize(input)
     if cache:
       cache.set(input, token)
-  return parse_tokens(token, kwargs)
+  return token
+
+def parse(input: str, kwargs: dict, cache: TokenCache|None=global_cache):
+  return parse_tokens(_tokens(input, cache), kwargs)
+
+def variables(input: str, cache: TokenCache|None=global_cache) -> set[str]:
+  """Names of the variables an expression refers to, without evaluating it."""
+  names = set()
+  token = _tokens(input, cache)
+  while token is not None:
+    if isinstance(token, Variable):
+      names.add(token.str_value)
+    token = token.next
+  return names
 
 
 binary_operators = [
@@ -52,7 +72,6 @@ class Token:
   is_closer = False
   # regex pattern
   pattern: str = ''
-  regex: re.Pattern = None
 
   def __init__(self, char: int, str_value: str):
     self.char = char
@@ -230,46 +249,52 @@ token_map: type[Token] = [
   BinaryOp,
 ]
 
-for token in token_map:
-  token.regex = re.compile(r'^\s*' + token.pattern)
+# All token patterns as one alternation, which like the list is tried in order.
+token_regex = re.compile(
+  '|'.join(f'(?P<{token.__name__}>{token.pattern})' for token in token_map))
+token_classes = {token.__name__: token for token in token_map}
+whitespace_regex = re.compile(r'\s*')
 
 def tokenize(input: str):
+  """
+  Scans the input in a single pass, returning the first of the linked tokens.
+  Token positions (`char`) are offsets into the input.
+  """
   stack: list[Token] = []
   prev: Token = None
-  char = 0
   first: Token|None = None
-  while input:
-    for token_class in token_map:
-      m = token_class.regex.match(input)
-      if m:
-        token_str = m.group(0)
-        input = input[len(token_str):].strip()
-        token: Token = token_class(char, token_str)
-        if not first:
-          first = token
-        if prev:
-          prev.next = token
-        if token.closer:
-          stack.append(token)
-        if token.is_closer:
-          if not stack:
-            raise AssertionError(
-              f'Unexpected {token.__class__.__name__}'
-            )
-          if token_class == stack[-1].closer:
-            other = stack.pop()
-            other.partner = token
-            token.partner = other
-          else:
-            raise AssertionError(
-              f'Expected {stack[-1].__class__.__name__}, got {token.__class__.__name__}')
-
-        char += len(token_str)
-        prev = token
-        break
-    else:
+  char = whitespace_regex.match(input).end()
+  if input and char == len(input):
+    raise AssertionError(f'Unrecognized token at character (0): {input[:10]}')
+  while char < len(input):
+    m = token_regex.match(input, char)
+    if m is None:
+      # the unconsumed input, trimmed as it was before tokens were matched
+      rest = input[char:].rstrip() if first else input
       raise AssertionError(
-        f'Unrecognized token at character ({char}): {input[:10]}')
+        f'Unrecognized token at character ({char}): {rest[:10]}')
+    token_class = token_classes[m.lastgroup]
+    token: Token = token_class(char, m.group())
+    if not first:
+      first = token
+    if prev:
+      prev.next = token
+    if token.closer:
+      stack.append(token)
+    if token.is_closer:
+      if not stack:
+        raise AssertionError(
+          f'Unexpected {token.__class__.__name__}'
+        )
+      if token_class == stack[-1].closer:
+        other = stack.pop()
+        other.partner = token
+        token.partner = other
+      else:
+        raise AssertionError(
+          f'Expected {stack[-1].__class__.__name__}, got {token.__class__.__name__}')
+    prev = token
+    char = whitespace_regex.match(input, m.end()).end()
   if stack:
     raise AssertionError(
       f'Unclosed f{stack[-1].__class__.__name__} at character ({stack[-1].char})')
@@ -1,7 +1,23 @@
+from __future__ import annotations
+
 from dataclasses import dataclass
-from itertools import chain
+from itertools import chain, product
+import collections
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+import typing
+import weakref
+import zipfile
+
+from backend import metrics
+from backend.lazy import lazy_import
 
-import trimesh as tm
+mf = lazy_import('manifold3d')
+np = lazy_import('numpy')
+tm = lazy_import('trimesh')
 
 @dataclass
 class Volume:
@@ -56,34 +72,523 @@ class Volume:
     )
 
 
+class MeshCache:
+  """
+  Stores shapes by key, handing out copies so cached entries stay intact, and
+  dropping the least recently used once they total more than `max_bytes`.
+  """
+  def __init__(self, max_bytes: int = 256 << 20):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.cache: collections.OrderedDict[typing.Hashable, Shape] = (
+      collections.OrderedDict())
+
+  def get(self, key: typing.Hashable):
+    shape = self.cache.get(key)
+    if shape is None:
+      _mesh_misses.inc()
+      return None
+    _mesh_hits.inc()
+    self.cache.move_to_end(key)
+    return shape.copy()
+
+  def set(self, key: typing.Hashable, shape: Shape):
+    if key in self.cache:
+      self.size -= self.cache.pop(key).nbytes
+    shape = shape.copy()
+    self.cache[key] = shape
+    self.size += shape.nbytes
+    # keeping the newest entry even when it alone is over the limit
+    while self.size > self.max_bytes and len(self.cache) > 1:
+      _, evicted = self.cache.popitem(last=False)
+      self.size -= evicted.nbytes
+
+# Set YASE_MESH_CACHE_MB to change how much memory is kept for loaded meshes and
+# primitives between renders.
+global_cache = MeshCache(int(os.environ.get('YASE_MESH_CACHE_MB', 256)) << 20)
+
+_mesh_hits = metrics.cache_requests.labels('mesh', 'hit')
+_mesh_misses = metrics.cache_requests.labels('mesh', 'miss')
+_disk_hits = metrics.cache_requests.labels('disk', 'hit')
+_disk_misses = metrics.cache_requests.labels('disk', 'miss')
+
+
+class DiskCache:
+  """
+  Stores meshes across runs as compressed .npz files in `path`, removing the
+  least recently used entries once they total more than `max_bytes`.
+  """
+  def __init__(self, path: str, max_bytes: int = 1 << 30):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.size: int|None = None
+
+  def _file(self, key: str):
+    return os.path.join(self.path, f'{key}.npz')
+
+  def _entries(self):
+    with os.scandir(self.path) as it:
+      return [e for e in it if e.name.endswith('.npz')]
+
+  def get(self, key: str) -> tuple[np.ndarray, np.ndarray]|None:
+    """Returns the stored vertex and face arrays, if any."""
+    try:
+      with np.load(self._file(key)) as data:
+        arrays = (data['vertices'], data['faces'])
+      os.utime(self._file(key))
+    except FileNotFoundError:
+      _disk_misses.inc()
+      return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+      # partially written or corrupt, drop it
+      with contextlib.suppress(OSError):
+        os.remove(self._file(key))
+      _disk_misses.inc()
+      return None
+    _disk_hits.inc()
+    return arrays
+
+  def set(self, key: str, vertices: np.ndarray, faces: np.ndarray):
+    # private to the user, as entries are trusted
+    os.makedirs(self.path, mode=0o700, exist_ok=True)
+    if self.size is None:
+      self.size = sum(e.stat().st_size for e in self._entries())
+    # write then rename, so concurrent runs never see a partial entry
+    fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+      np.savez_compressed(fh, vertices=vertices, faces=faces)
+    self.size += os.path.getsize(tmp)
+    os.replace(tmp, self._file(key))
+    if self.size > self.max_bytes:
+      self.evict()
+
+  def evict(self):
+    entries = sorted(
+      ((e.stat().st_mtime_ns, e.stat().st_size, e.path) for e in self._entries()))
+    self.size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if self.size <= self.max_bytes:
+        break
+      with contextlib.suppress(OSError):
+        os.remove(path)
+      self.size -= size
+
+
+# Set YASE_CACHE_DIR to keep loaded meshes and booleans between runs, and to
+# share them between processes.
+disk_cache: DiskCache|None = None
+if os.environ.get('YASE_CACHE_DIR'):
+  disk_cache = DiskCache(
+    os.environ['YASE_CACHE_DIR'],
+    int(os.environ.get('YASE_CACHE_MB', 1024)) << 20)
+
+
+# Set YASE_COMPACT to hold meshes as float32 vertices and int32 faces, without
+# trimesh's derived caches, until a trimesh is needed for output.
+compact = bool(os.environ.get('YASE_COMPACT'))
+
+
+def _pattern_matrices(transforms) -> np.ndarray:
+  """4x4 matrices from a list of [x, y, z] offsets or of matrices."""
+  transforms = np.asarray(transforms, dtype=np.float64)
+  if transforms.shape[1:] == (4, 4):
+    return transforms
+  matrices = np.tile(np.eye(4), (len(transforms), 1, 1))
+  matrices[:, :3, 3] = transforms.reshape(-1, 3)
+  return matrices
+
+
+def _instances_meet(bounds: np.ndarray, transforms: np.ndarray) -> bool:
+  """
+  Whether the bounding boxes of any two transformed instances overlap or
+  touch, sweeping along x. Boxes are conservative, so instances that only
+  come close are still unioned.
+  """
+  corners = np.array(list(product(*bounds.T)))
+  placed = (np.einsum('nij,cj->nci', transforms[:, :3, :3], corners)
+            + transforms[:, None, :3, 3])
+  low, high = placed.min(axis=1), placed.max(axis=1)
+  tolerance = 1e-9 * max(1.0, float(np.abs(placed).max()))
+  order = np.argsort(low[:, 0])
+  low, high = low[order], high[order]
+  for i in range(len(low) - 1):
+    end = np.searchsorted(low[:, 0], high[i, 0] + tolerance, side='right')
+    others = slice(i + 1, end)
+    if np.any(np.all((low[others] <= high[i] + tolerance)
+                     & (low[i] <= high[others] + tolerance), axis=1)):
+      return True
+  return False
+
+
+# Bump when cached results would be computed differently, so that entries in
+# a persistent YASE_CACHE_DIR aren't served in their place.
+CACHE_VERSION = 1
+
+
+def _digest(*parts) -> str:
+  # compact results are float32, so kept apart from full width ones
+  return hashlib.sha256(repr((CACHE_VERSION, compact, *parts)).encode()).hexdigest()
+
+
+# (path, mtime) => digest of file contents
+_file_keys: dict[tuple[str, int], str] = {}
+
+
+def _references(held: list[tuple[object, int]]) -> list[int]:
+  """Reference counts of the held objects, as seen from here."""
+  return [sys.getrefcount(obj) for obj, _ in held]
+
+
+# The count for an object referred to by nothing but its list of held objects.
+_UNREFERENCED = _references([(object(), 0)])[0]
+
+
+# Unit sized solids, matching the orientation of the stls in input/
+primitives: dict[str, typing.Callable[[int], tm.Trimesh]] = {
+  'box': lambda _: tm.creation.box(bounds=[[0, 0, 0], [1, 1, 1]]),
+  'cylinder': lambda segments: tm.creation.cylinder(
+    radius=0.5, height=1, sections=segments),
+  'cone': lambda segments: tm.creation.cone(
+    radius=0.5, height=1, sections=segments),
+  # the triangle is in the yz plane, with the right angle at the origin, and
+  # extruded along x
+  'wedge': lambda _: tm.creation.extrude_triangulation(
+    [[0, 0], [1, 0], [0, 1]], [[0, 1, 2]], height=1).apply_transform(
+      [[0, 0, 1, 0], [1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 0, 1]]),
+}
+
+DEFAULT_SEGMENTS = 48
+
+# Bisections of the tolerance when simplifying to a face budget.
+SIMPLIFY_STEPS = 6
+# The most surfaces may move when simplifying, as a fraction of the diagonal,
+# and the most the volume may change.
+SIMPLIFY_MAX_TOLERANCE = 0.01
+SIMPLIFY_MAX_VOLUME_CHANGE = 0.1
+
+# File types shapes can be written as. STL repeats each vertex for every face
+# using it, where the indexed ply (binary) and glb are about a third the size.
+OUTPUT_FORMATS = ('stl', 'ply', 'glb')
+
+
 class Shape:
-  def __init__(self, mesh: tm.Trimesh):
-     self.mesh = mesh
+  """
+  A solid, held as a trimesh and/or a manifold3d Manifold. Booleans leave the
+  result as a Manifold, so consecutive booleans and transforms don't convert
+  back and forth; the trimesh is only built when its vertices are needed.
+
+  In compact mode, meshes are instead held as float32 vertex and int32 face
+  arrays, which the Manifold is built from without widening. These arrays are
+  never modified in place, so copies share them.
+
+  An inverted shape is subtracted, rather than added, when merged. Previews
+  skip booleans, keeping subtracted shapes as positioned `cutouts`.
+  """
+  def __init__(self, mesh: tm.Trimesh|None = None, key: str|None = None,
+               manifold: mf.Manifold|None = None,
+               arrays: tuple[np.ndarray, np.ndarray]|None = None):
+     self._mesh = mesh
+     self._manifold = manifold
+     self._arrays = arrays
+     # digest of the inputs and operations that built the mesh, if known
+     self.key = key
+     self.inverted = False
+     self.cutouts: list[Shape] = []
+     # temporary file holding the mesh while spilled out of memory
+     self._spilled: weakref.finalize|None = None
+
+  def _held(self) -> list[tuple[object, int]]:
+    """What holds the mesh in memory, in each form, with its approximate bytes."""
+    held = []
+    if self._arrays is not None:
+      held += [(array, array.nbytes) for array in self._arrays]
+    if self._mesh is not None:
+      held.append(
+        (self._mesh, self._mesh.vertices.nbytes + self._mesh.faces.nbytes))
+    if self._manifold is not None:
+      # float32 vertices and uint32 triangles
+      held.append((
+        self._manifold,
+        (self._manifold.num_vert() + self._manifold.num_tri()) * 12))
+    return held
+
+  @property
+  def buffers(self) -> dict[int, int]:
+    """
+    Bytes held by the mesh, keyed by the id of what holds them, so that the
+    manifold and arrays shared between copies can be counted once.
+    """
+    return {id(obj): size for obj, size in self._held()}
+
+  @property
+  def nbytes(self) -> int:
+    """Approximate bytes held in memory by the mesh, in either form."""
+    return sum(self.buffers.values())
+
+  @property
+  def spilled(self) -> bool:
+    return self._spilled is not None
+
+  def spill(self) -> int:
+    """
+    Writes the mesh to a temporary file and releases it from memory, returning
+    the bytes freed, which leaves out a manifold or arrays still held by a copy
+    (or anything else). It is read back when next used.
+    """
+    if self._spilled is not None:
+      return 0
+    # before building any trimesh just to write out
+    mesh, held = self._mesh, self._held()
+    vertices, faces = self._vertices_faces()
+    fd, path = tempfile.mkstemp(prefix='yase-spill-', suffix='.npz')
+    with os.fdopen(fd, 'wb') as fh:
+      np.savez(fh, vertices=vertices, faces=faces)
+    del vertices, faces
+    self._mesh = self._manifold = self._arrays = None
+    self._spilled = weakref.finalize(self, os.remove, path)
+    # copies never share the trimesh, but anything else is only freed when
+    # nothing besides `held` refers to it
+    return sum(
+      size for (obj, size), count in zip(held, _references(held))
+      if obj is mesh or count <= _UNREFERENCED)
+
+  def _restore(self):
+    if self._spilled is None:
+      return
+    _, _, (path,), _ = self._spilled.peek()
+    with np.load(path) as data:
+      self._set_arrays(data['vertices'], data['faces'])
+    self._spilled()
+    self._spilled = None
+
+  @property
+  def mesh(self) -> tm.Trimesh:
+    self._restore()
+    if self._mesh is None:
+      if self._arrays is not None:
+        vertices, faces = self._arrays
+      else:
+        with metrics.evaluation_seconds.time():
+          result = self._manifold.to_mesh()
+        vertices, faces = result.vert_properties[:, :3], result.tri_verts
+      self._mesh = tm.Trimesh(vertices=vertices, faces=faces, process=False)
+    return self._mesh
+
+  @mesh.setter
+  def mesh(self, mesh: tm.Trimesh):
+    if self._spilled is not None:
+      self._spilled()
+      self._spilled = None
+    self._mesh = mesh
+    self._manifold = self._arrays = None
+
+  @property
+  def manifold(self) -> mf.Manifold:
+    self._restore()
+    if self._manifold is None:
+      if self._arrays is not None:
+        vertices, faces = self._arrays[0], self._arrays[1].view(np.uint32)
+      else:
+        if not self._mesh.is_volume:
+          raise ValueError('Not all meshes are volumes!')
+        vertices = np.array(self._mesh.vertices, dtype=np.float32)
+        faces = np.array(self._mesh.faces, dtype=np.uint32)
+      self._manifold = mf.Manifold(
+        mesh=mf.Mesh(vert_properties=vertices, tri_verts=faces))
+      if self._manifold.status() != mf.Error.NoError:
+        self._manifold = None
+        raise ValueError('Not all meshes are volumes!')
+    return self._manifold
+
+  @property
+  def is_empty(self) -> bool:
+    return len(self._vertices_faces()[1]) == 0
+
+  def _vertices_faces(self) -> tuple[np.ndarray, np.ndarray]:
+    """The vertex and face arrays, in whichever width they are held."""
+    self._restore()
+    if self._mesh is None and self._arrays is not None:
+      return self._arrays
+    return np.asarray(self.mesh.vertices), np.asarray(self.mesh.faces)
+
+  def _set_arrays(self, vertices: np.ndarray, faces: np.ndarray):
+    """Holds the given vertex and face arrays, compactly when enabled."""
+    self._manifold = None
+    if compact:
+      self._mesh = None
+      self._arrays = (np.ascontiguousarray(vertices, dtype=np.float32),
+                      np.ascontiguousarray(faces, dtype=np.int32))
+    else:
+      self._arrays = None
+      self._mesh = tm.Trimesh(vertices=vertices, faces=faces, process=False)
+    return self
+
+  def compact(self):
+    """Narrows a trimesh to float32 vertices and int32 faces, dropping it."""
+    self._restore()
+    if self._mesh is not None:
+      self._arrays = (np.ascontiguousarray(self._mesh.vertices, dtype=np.float32),
+                      np.ascontiguousarray(self._mesh.faces, dtype=np.int32))
+      self._mesh = None
+
+  def _transform(self, matrix: np.ndarray):
+    """Applies a 4x4 transform to whichever form the shape is held in."""
+    self._restore()
+    for cutout in self.cutouts:
+      cutout._transform(matrix)
+    if self._mesh is not None:
+      self._mesh.apply_transform(matrix)
+      self._manifold = self._arrays = None
+    elif self._manifold is not None:
+      self._manifold = self._manifold.transform(matrix[:3, :4])
+      self._arrays = None
+    else:
+      vertices, faces = self._arrays
+      narrow = matrix.astype(np.float32)
+      vertices = vertices @ narrow[:3, :3].T + narrow[:3, 3]
+      if np.linalg.det(matrix[:3, :3]) < 0:
+        # mirrored, so keep the faces pointing outwards
+        faces = np.ascontiguousarray(faces[:, ::-1])
+      self._arrays = (vertices, faces)
+
+  def _derive(self, *operation):
+    """Records an operation applied to the mesh in the shape's key."""
+    if self.key is not None:
+      self.key = _digest(self.key, *operation)
+
+  @classmethod
+  def _cached(cls, cache: MeshCache|None, key: tuple, digest: str,
+              build: typing.Callable[[], Shape]):
+    """
+    Looks a shape up in the mesh cache, then the disk cache, only building it
+    when in neither. Built shapes are stored in both.
+    """
+    shape = None if cache is None else cache.get(key)
+    if shape is None:
+      stored = None if disk_cache is None else disk_cache.get(digest)
+      if stored is not None:
+        shape = Shape(key=digest)._set_arrays(*stored)
+      else:
+        shape = build()
+        shape.key = digest
+        if compact:
+          shape.compact()
+        if disk_cache is not None:
+          disk_cache.set(digest, *shape._vertices_faces())
+      if cache is not None:
+        cache.set(key, shape)
+    return shape
 
   @classmethod
-  def load(cls, filename: str):
-    return Shape(tm.load_mesh(filename))
+  def load(cls, filename: str, cache: MeshCache|None = global_cache,
+           faces: int|None = None, tolerance: float|None = None):
+    """
+    Loads a mesh file, reusing the cached mesh while the file is unchanged. The
+    parsed mesh is also kept in the disk cache when enabled, so other processes
+    (e.g. server workers) needn't parse it again.
+
+    Given a face budget or tolerance, the mesh is simplified, with the result
+    cached alongside the original.
+    """
+    key = ('file', os.path.abspath(filename), os.stat(filename).st_mtime_ns)
+    if key not in _file_keys:
+      with open(filename, 'rb') as fh:
+        _file_keys[key] = _digest('file', hashlib.file_digest(fh, 'sha256').hexdigest())
+    if faces is None and tolerance is None:
+      return cls._cached(
+        cache, key, _file_keys[key], lambda: Shape(tm.load_mesh(filename)))
+
+    def simplified():
+      shape = cls.load(filename, cache)
+      shape.simplify(faces, tolerance)
+      return shape
+    return cls._cached(
+      cache, (*key, 'simplify', faces, tolerance),
+      _digest(_file_keys[key], 'simplify', faces, tolerance), simplified)
+
+  @classmethod
+  def primitive(cls, kind: str, size: list[float], segments: int|None = None,
+                cache: MeshCache|None = global_cache):
+    """
+    Generates a solid of the given kind, zeroed and sized to [x, y, z]. Segments
+    only applies to round solids.
+    """
+    if kind not in primitives:
+      raise ValueError(f'Unrecognized primitive: "{kind}"')
+    segments = int(segments or DEFAULT_SEGMENTS)
+    key = ('primitive', kind, tuple(float(n) for n in size), segments)
+    shape = None if cache is None else cache.get(key)
+    if shape is None:
+      mesh = primitives[kind](segments)
+      mesh.apply_translation(-mesh.bounds[0])
+      mesh.apply_scale(np.array(key[2]) / mesh.extents)
+      shape = Shape(mesh, _digest(*key))
+      if compact:
+        shape.compact()
+      if cache is not None:
+        cache.set(key, shape)
+    return shape
   
-  def save(self, filename: str, fh=None):
+  def save(self, filename: str, fh=None, file_type: str = 'stl'):
     # trimesh does not support filenames in STL headers
-    self.mesh.export(fh or filename, file_type='stl')
+    self.mesh.export(fh or filename, file_type=file_type)
+
+  def encode(self, file_type: str = 'stl') -> bytes:
+    """Returns the mesh as file contents, STL unless given one of OUTPUT_FORMATS."""
+    return self.mesh.export(file_type=file_type)
+
+  def fingerprint(self):
+    """A digest of the mesh's vertices and faces, identifying its content."""
+    vertices, faces = self._vertices_faces()
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(vertices, dtype=np.float64))
+    digest.update(np.ascontiguousarray(faces, dtype=np.int64))
+    for cutout in self.cutouts:
+      digest.update(cutout.fingerprint().encode())
+    return digest.hexdigest()
+
+  @property
+  def bounds(self) -> np.ndarray:
+    """[[x_min, y_min, z_min], [x_max, y_max, z_max]]"""
+    self._restore()
+    if self._mesh is None and self._manifold is not None:
+      return np.array(self._manifold.bounding_box()).reshape(2, 3)
+    if self._mesh is None:
+      vertices = self._arrays[0]
+      return np.array([vertices.min(axis=0), vertices.max(axis=0)], dtype=np.float64)
+    bbox: tm.primitives.Box = self._mesh.bounding_box
+    return bbox.bounds
 
   @property
   def volume(self):
-    bbox: tm.primitives.Box = self.mesh.bounding_box
-    # bbox.bounds of np.float64: 
-    #   [[x_min, y_min, z_min], [x_max, y_max, z_max]]
     return Volume(
-      *(float(n) for n in chain(*zip(*bbox.bounds)))
+      *(float(n) for n in chain(*zip(*self.bounds)))
     )
 
   def copy(self):
-     return Shape(self.mesh.copy())
+     # manifolds and compact arrays are immutable, so may be shared
+     self._restore()
+     mesh = None if self._mesh is None else self._mesh.copy()
+     shape = Shape(mesh, self.key, self._manifold, self._arrays)
+     shape.inverted = self.inverted
+     shape.cutouts = [cutout.copy() for cutout in self.cutouts]
+     return shape
+
+  def to_state(self):
+    """Vertex and face arrays, for sending the shape between processes."""
+    return (*self._vertices_faces(), self.key, self.inverted)
+
+  @classmethod
+  def from_state(cls, state: tuple[np.ndarray, np.ndarray, str|None, bool]):
+    vertices, faces, key, inverted = state
+    shape = Shape(key=key)._set_arrays(vertices, faces)
+    shape.inverted = inverted
+    return shape
 
   def zero(self):
      """Moves the min x/y/z points to zero."""
-     bbox: tm.primitives.Box = self.mesh.bounding_box
-     self.mesh.apply_translation(-1 * bbox.bounds[0])
+     self._transform(tm.transformations.translation_matrix(-1 * self.bounds[0]))
+     self._derive('zero')
 
   def center(self, x, y, z):
      v = self.volume
@@ -95,10 +600,18 @@ class Shape:
 
   def translate(self, dx: float, dy: float, dz: float):
      """Applies a constant offset the x/y/z points."""
-     self.mesh.apply_translation([dx, dy, dz])
+     self._transform(tm.transformations.translation_matrix([dx, dy, dz]))
+     self._derive('translate', float(dx), float(dy), float(dz))
 
   def scale(self, x, y, z):
-     self.mesh.apply_scale([x, y, z])
+     self._transform(np.diag([float(x), float(y), float(z), 1.0]))
+     self._derive('scale', float(x), float(y), float(z))
+
+  def rotate(self, axis: list[float], degrees: float):
+     """Rotates around the given axis through the origin, in degrees."""
+     self._transform(
+        tm.transformations.rotation_matrix(np.radians(degrees), axis))
+     self._derive('rotate', [float(n) for n in axis], float(degrees))
 
   def set_width(self, width: float):
      x = float(width) / self.volume.width
@@ -119,8 +632,135 @@ class Shape:
     z = float(depth) / vol.depth
     self.scale(x, y, z)
 
+  def pattern(self, transforms: np.ndarray):
+    """
+    Returns a single shape holding a copy of this mesh for each transform,
+    given as [x, y, z] offsets or 4x4 matrices. Instances that don't overlap
+    are gathered into one mesh as they are, while overlapping ones are
+    unioned, as concatenating them wouldn't be a valid solid.
+    """
+    transforms = _pattern_matrices(transforms)
+    key = None
+    if self.key is not None:
+      key = _digest(
+        self.key, 'pattern', hashlib.sha256(np.ascontiguousarray(transforms)).hexdigest())
+    if _instances_meet(self.bounds, transforms):
+      shape = Shape(key=key, manifold=mf.Manifold.batch_boolean(
+        [self.manifold.transform(m[:3, :4]) for m in transforms], mf.OpType.Add))
+    else:
+      vertices, faces = self._vertices_faces()
+      placed = (np.einsum('nij,vj->nvi', transforms[:, :3, :3], vertices)
+                + transforms[:, None, :3, 3])
+      # mirrored instances keep their faces pointing outwards
+      mirrored = np.linalg.det(transforms[:, :3, :3]) < 0
+      faces = np.where(mirrored[:, None, None], faces[None, :, ::-1], faces[None])
+      shift = np.arange(len(transforms)) * len(vertices)
+      shape = Shape(key=key)._set_arrays(
+        placed.reshape(-1, 3), (faces + shift[:, None, None]).reshape(-1, 3))
+    shape.inverted = self.inverted
+    shape.cutouts = [cutout.pattern(transforms) for cutout in self.cutouts]
+    return shape
+
+  def _boolean(self, operation: str, other: 'Shape'):
+    """
+    Replaces the shape with the result of a manifold boolean operation, via
+    the disk cache when enabled and both shapes have known keys.
+    """
+    with metrics.boolean_seconds.labels(operation).time():
+      key = None
+      if self.key is not None and other.key is not None:
+        key = _digest(operation, self.key, other.key)
+      cached = None
+      if key is not None and disk_cache is not None:
+        cached = disk_cache.get(key)
+      if cached is not None:
+        self._set_arrays(*cached)
+      else:
+        if operation == 'union':
+          self._manifold = self.manifold + other.manifold
+        else:
+          self._manifold = self.manifold - other.manifold
+        # manifold builds the operation lazily, so run it here to time it
+        self._manifold.num_tri()
+        self._mesh = self._arrays = None
+        if key is not None and disk_cache is not None:
+          with metrics.evaluation_seconds.time():
+            result = self._manifold.to_mesh()
+          disk_cache.set(key, result.vert_properties[:, :3], result.tri_verts)
+      self.key = key
+
   def merge(self, other: 'Shape'):
-    self.mesh = tm.boolean.union([self.mesh, other.mesh], engine='manifold')
+    self._boolean('union', other)
 
   def subtract(self, other: 'Shape'):
-    self.mesh = tm.boolean.difference([self.mesh, other.mesh], engine='manifold')
+    self._boolean('difference', other)
+
+  def simplify(self, faces: int|None = None, tolerance: float|None = None):
+    """
+    Reduces the number of faces, moving surfaces by at most `tolerance`, or
+    by about the least tolerance that leaves no more than `faces` faces.
+
+    Tolerances are capped at SIMPLIFY_MAX_TOLERANCE of the shape's diagonal,
+    and results changing the volume by over SIMPLIFY_MAX_VOLUME_CHANGE are
+    passed over, so a budget that can't be met leaves the closest mesh that
+    still keeps its shape.
+    """
+    manifold = self.manifold
+    volume = manifold.volume()
+    limit = SIMPLIFY_MAX_TOLERANCE * float(
+      np.linalg.norm(self.bounds[1] - self.bounds[0]))
+
+    def keeps_shape(candidate) -> bool:
+      return candidate.num_tri() >= 4 and (
+        abs(candidate.volume() - volume) <= SIMPLIFY_MAX_VOLUME_CHANGE * volume)
+
+    if tolerance is not None:
+      candidate = manifold.simplify(min(float(tolerance), limit))
+      if keeps_shape(candidate):
+        manifold = candidate
+    if faces is not None and manifold.num_tri() > faces:
+      # widen the tolerance until within budget...
+      result, low, high = manifold, 0.0, limit * 1e-2
+      while keeps_shape(candidate := manifold.simplify(high)):
+        result = candidate
+        if candidate.num_tri() <= faces:
+          # ...then narrow it back towards the budget
+          for _ in range(SIMPLIFY_STEPS):
+            middle = (low + high) / 2
+            candidate = manifold.simplify(middle)
+            if candidate.num_tri() <= faces and keeps_shape(candidate):
+              high, result = middle, candidate
+            else:
+              low = middle
+          break
+        if high >= limit:
+          break
+        low, high = high, min(high * 2, limit)
+      manifold = result
+    self._manifold = manifold
+    self._mesh = self._arrays = None
+    self._derive('simplify', faces, tolerance)
+
+  def invert(self):
+    """Toggles whether the shape is subtracted when merged."""
+    self.inverted = not self.inverted
+    self._derive('invert')
+
+  def combine(self, other: 'Shape'):
+    """
+    Adds the other shape without a boolean, for previews: added shapes are
+    concatenated with this mesh, and subtracted ones are kept as cutouts.
+    """
+    if other.inverted:
+      cutout = other.copy()
+      cutout.inverted = False
+      cutout.cutouts = []
+      self.cutouts.append(cutout)
+    else:
+      vertices, faces = self._vertices_faces()
+      other_vertices, other_faces = other._vertices_faces()
+      self._set_arrays(
+        np.concatenate([vertices, other_vertices]),
+        np.concatenate([faces, other_faces + len(vertices)]))
+      self.cutouts.extend(cutout.copy() for cutout in other.cutouts)
+    self.key = None
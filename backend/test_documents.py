@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+
+from backend.documents import DocumentSplitter, parse_document, read_documents
+
+
+class TestDocuments(unittest.TestCase):
+  def test_splitter(self):
+    for (input, expected) in [
+      ('a: 1\n', [{'a': 1}]),
+      ('a: 1\n---\nb: 2\n', [{'a': 1}, {'b': 2}]),
+      ('---\na: 1\n...\n---\nb: 2', [{'a': 1}, {'b': 2}]),
+      ('--- {a: 1}\n--- {b: 2}\n', [{'a': 1}, {'b': 2}]),
+      ('# comment\n---\na: 1\n---\n\n', [{'a': 1}]),
+      ('{"a": 1}\n{"b": 2}\n', [{'a': 1}, {'b': 2}]),
+      ('a:\n  b: {c: 1}\n', [{'a': {'b': {'c': 1}}}]),
+    ]:
+      with self.subTest(input=input):
+        splitter = DocumentSplitter()
+        docs = [d for c in input for d in splitter.feed(c)] + splitter.close()
+        self.assertEqual([parse_document(d) for d in docs], expected)
+
+  def test_incremental(self):
+    splitter = DocumentSplitter()
+    self.assertEqual(splitter.feed('a: 1\n--'), [])
+    self.assertEqual(splitter.feed('-\nb:'), ['a: 1'])
+    self.assertEqual(splitter.feed(' 2\n---\n{"c": 3}\n{"d"'), ['\nb: 2', '{"c": 3}'])
+    self.assertEqual(splitter.close(), ['{"d"'])
+
+  def test_read_documents(self):
+    async def chunks():
+      # split within a multibyte character
+      data = 'a: "\u00e9"\n---\nb: 2\n'.encode()
+      yield data[:5]
+      yield data[5:]
+
+    async def read():
+      return [parse_document(d) async for d in read_documents(chunks())]
+
+    self.assertEqual(asyncio.run(read()), [{'a': '\u00e9'}, {'b': 2}])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,215 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from backend import farm
+import backend.executor
+from backend.executor import (
+  Context, ExecutorEnvironment, MeshMemory, count_outputs, executor,
+  split_invariant)
+from backend.shape import Shape
+
+
+class TestExecutor(unittest.TestCase):
+  def test_count_outputs(self):
+    for (config, expected) in [
+      ({}, 0),
+      ({'save_as': 'a.stl'}, 1),
+      ({'iterate': 3, 'save_as': 'a.stl'}, 3),
+      ({'iterate': [2, 8, 2], 'save_as': 'a.stl'}, 3),
+      ({'iterate': [{'a': 1}, {'a': 2}], 'save_as': 'a.stl'}, 2),
+      ({'iterate': {'eval': 'n'}, 'save_as': 'a.stl'}, None),
+      ({'iterate': 2, 'branch': [
+        {'save_as': 'a.stl'},
+        {'iterate': 3, 'save_as': 'b.stl'},
+      ]}, 8),
+      ({'then': [{'save_as': 'a.stl'}, {'save_as': 'b.stl'}],
+        'with': {'save_as': 'c.stl'}}, 3),
+      ([{'save_as': 'a.stl'}, {'iterate': 4, 'save_as': 'b.stl'}], 5),
+      ({'branch': [{'iterate': {'eval': 'n'}, 'save_as': 'a.stl'}]}, None),
+    ]:
+      with self.subTest(config=config):
+        self.assertEqual(count_outputs(config), expected)
+
+  def test_split_invariant(self):
+    for (config, names, hoisted) in [
+      ({'base': 'a.stl', 'save_as': '{arg0}.stl'}, {'arg0'}, ['base']),
+      ({'base': '{arg0}.stl', 'rotate_x': 90}, {'arg0'}, []),
+      ({'base': 'a.stl', 'print': '{}', 'load': 'b.stl',
+        'translate': {'eval': ['arg0 * 5', 0, 0]}, 'rebase': True},
+       {'arg0'}, ['base', 'load']),
+      ({'var': {'w': {'eval': 'x * 2'}}, 'base': {'box': [{'eval': 'w'}, 1, 1]}},
+       {'x'}, []),
+      ({'var': {'w': 2}, 'base': {'box': [{'eval': 'w'}, 1, 1]}}, {'x'}, ['var', 'base']),
+      ({'var': {'x': 2}, 'base': 'a.stl'}, {'x'}, ['base']),
+      ({'base': 'a.stl', 'offset_mask': [1, 0, 0], 'rebase': True}, {'arg0'}, ['base']),
+      ({'base': {'box': [{'eval': '1 $'}, 1, 1]}}, {'arg0'}, []),
+    ]:
+      with self.subTest(config=config):
+        before, after = split_invariant(config, names)
+        self.assertEqual(list(before), hoisted)
+        self.assertEqual(before | after, config)
+
+  def test_hoisting(self):
+    config = {
+      'iterate': 3,
+      'base': {'box': [20, 5, 20]},
+      'load': {'cylinder': [2, 2, 2]},
+      'attach': 'top_center',
+      'translate': [{'eval': 'arg0 * 3'}, 0, 0],
+      'save_as': 'a{arg0}.stl',
+    }
+    results = []
+    for split in (split_invariant, lambda config, _: ({}, config)):
+      env = farm.ExecutorEnvCollect()
+      with (mock.patch.object(backend.executor, 'split_invariant', split),
+            mock.patch.object(Shape, 'primitive', wraps=Shape.primitive) as primitive):
+        asyncio.run(Context(executor, env=env).process(config))
+      results.append((env.events, primitive.call_count))
+    (hoisted, hoisted_calls), (repeated, repeated_calls) = results
+    self.assertEqual(hoisted, repeated)
+    self.assertEqual(hoisted_calls, 2)
+    self.assertEqual(repeated_calls, 6)
+
+    # failures in hoisted commands report the iteration's path, as unhoisted
+    for failing in [{'load': 'missing.stl'}, {'load': {'box': [1, 1]}}]:
+      with self.subTest(failing=failing):
+        results = []
+        for split in (split_invariant, lambda config, _: ({}, config)):
+          env = farm.ExecutorEnvCollect()
+          with mock.patch.object(backend.executor, 'split_invariant', split):
+            try:
+              asyncio.run(Context(executor, env=env).process(dict(config, **failing)))
+            except Exception as e:
+              env.events.append(('raised', repr(e)))
+          results.append(env.events)
+        self.assertEqual(results[0], results[1])
+    self.assertTrue(results[0][0][1].startswith('[iterate.0.load] Expected'))
+
+  def test_scope(self):
+    ctx = Context(executor)
+    ctx.kwargs.update(a=1, b=2)
+    child = ctx.copy()
+    child.push_arg(5)
+    child.kwargs['a'] = 3
+    self.assertEqual(child.format('{0} {arg0} {a} {b}'), '5 5 3 2')
+    self.assertEqual(dict(ctx.kwargs_with_args), {'a': 1, 'b': 2})
+    self.assertEqual(ctx.args, [])
+    # args win over variables of the same name, however deep those are set
+    child.kwargs['arg0'] = 7
+    self.assertEqual(child.format('{arg0}'), '5')
+    grandchild = child.copy()
+    grandchild.kwargs['arg0'] = 8
+    self.assertEqual(grandchild.format('{arg0}'), '5')
+    self.assertIs(grandchild.env, ctx.env)
+
+  def test_memory_budget(self):
+    config = {
+      'base': {'box': [20, 5, 20]},
+      'iterate': 2,
+      'load': {'cylinder': [2, 2, 2]},
+      'branch': [{'iterate': 2, 'attach': 'top_center', 'save_as': 'a{arg0}{arg1}.stl'}],
+    }
+    results = []
+    for limit in (None, 1):
+      env = farm.ExecutorEnvCollect()
+      env.memory = MeshMemory(limit)
+      asyncio.run(Context(executor, env=env).process(config))
+      results.append((env.events, env.memory))
+    (unlimited, memory), (budgeted, spilling) = results
+    self.assertEqual(budgeted, unlimited)
+    # without a limit, meshes aren't measured (which would evaluate them)
+    self.assertEqual(memory.peak, 0)
+    self.assertEqual(memory.spills, 0)
+    self.assertGreater(spilling.peak, 0)
+    self.assertGreater(spilling.spills, 0)
+
+  def test_memory_keep(self):
+    memory = MeshMemory(1)
+    parent, child = Context(executor), Context(executor)
+    for ctx in (parent, child):
+      ctx.shape = Shape.primitive('box', [1, 1, 1], cache=None)
+      memory.enter(ctx)
+    with memory.keep(parent):
+      self.assertTrue(memory.check(child))
+    self.assertFalse(parent.shape.spilled)
+    self.assertTrue(memory.check(child))
+    self.assertTrue(parent.shape.spilled)
+
+  def test_memory_shared(self):
+    memory = MeshMemory(1)
+    parent = Context(executor)
+    parent.shape = Shape.primitive('box', [1, 1, 1], cache=None)
+    parent.shape.merge(Shape.primitive('box', [2, 2, 2], cache=None))
+    child = parent.copy()
+    for ctx in (parent, child):
+      memory.enter(ctx)
+    single = parent.shape.nbytes
+    # the copy's manifold is the parent's, so is counted once and not spilled
+    self.assertTrue(memory.check(child))
+    self.assertEqual(memory.peak, single)
+    self.assertFalse(parent.shape.spilled)
+    self.assertEqual(parent.shape.spill(), 0)
+    self.assertEqual(child.shape.spill(), single)
+
+  def test_save_empty(self):
+    env = farm.ExecutorEnvCollect()
+    asyncio.run(Context(executor, env=env).process({
+      'base': {'box': [1, 1, 1]},
+      'load': {'box': [3, 3, 3]},
+      'invert': True,
+      'translate': [-1, -1, -1],
+      'save_as': 'empty.stl',
+    }))
+    self.assertEqual(env.events, [
+      ('error', '[save_as] Not saving empty.stl, as the mesh is empty')])
+
+  def test_references(self):
+    config = {
+      'base': {'box': [4, 4, 4]},
+      'branch': [
+        {'load': {'box': [size] * 3}, 'attach': 'top_center', 'save_as': name}
+        for size, name in [
+          (1, 'part.stl'), (2, 'part.stl'), (1, 'small.stl'), (2, 'large.stl')]
+      ],
+    }
+    env = farm.ExecutorEnvCollect()
+    asyncio.run(Context(executor, env=env).process(config))
+    self.assertEqual([event[:2] for event in env.events], [
+      ('save', 'part.stl'), ('save', 'part.stl'), ('save', 'small.stl'),
+      ('reference', 'large.stl')])
+    # refers to the name holding that content now, not the first to have it
+    self.assertEqual(env.events[-1][2], 'part.stl')
+    self.assertEqual(env.events[2][2], env.events[0][2])
+
+  def test_preview(self):
+    config = {
+      'base': {'box': [40, 10, 40]},
+      'then': [
+        {'load': {'cylinder': [4, 20, 4]}, 'invert': True,
+         'attach': 'top_center', 'offset': [0, -15, 0]},
+        {'load': {'box': [2, 2, 2]}, 'attach': 'top_center', 'save_as': 'a.stl'},
+      ],
+    }
+
+    class Capture(ExecutorEnvironment):
+      async def save(self, ctx: Context, filename: str, _: dict):
+        self.shape = ctx.shape
+
+    shapes = []
+    for preview in (False, True):
+      env = Capture()
+      env.preview = preview
+      asyncio.run(Context(executor, env=env).process(config))
+      shapes.append(env.shape)
+    full, preview = shapes
+    self.assertEqual(full.cutouts, [])
+    self.assertLess(full.mesh.volume, 40 * 10 * 40 + 8)
+    self.assertIsNone(preview._manifold)
+    self.assertEqual(len(preview.cutouts), 1)
+    self.assertAlmostEqual(preview.mesh.volume, 40 * 10 * 40 + 8)
+    self.assertEqual(preview.volume.to_dict(), full.volume.to_dict())
+
+
+if __name__ == '__main__':
+  unittest.main()
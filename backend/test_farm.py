@@ -0,0 +1,137 @@
+from pathlib import Path
+import asyncio
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from backend import farm, transport
+from backend.executor import Context, ExecutorEnvironment, executor
+
+
+CONFIG = {
+  'base': {'box': [20, 5, 20]},
+  'iterate': [{'n': 'a'}, {'n': 'b'}],
+  'load': {'box': [2, 2, 2]},
+  'attach': 'top_center',
+  'branch': [
+    {'save_as': 'out-{n}.stl'},
+    {'iterate': [3], 'offset_mask': [3, 0, 0], 'save_as': 'out-{n}-{arg0}.stl'},
+  ],
+}
+
+
+class TestFarm(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.tmp = tempfile.TemporaryDirectory()
+    os.chdir(self.tmp.name)
+    os.mkdir('output')
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.tmp.cleanup()
+
+  def test_split(self):
+    jobs: list[farm.Job] = []
+    env = farm.ExecutorEnvCoordinator(jobs.append)
+    asyncio.run(Context(executor, env=env).process(CONFIG))
+    self.assertEqual([j.index for j in jobs], list(range(8)))
+    self.assertEqual(jobs[0].state['path'], ['iterate', '0', 'branch', '0'])
+    self.assertEqual(jobs[0].config, {'save_as': 'out-{n}.stl'})
+
+    result = asyncio.run(farm.run_job(jobs[3]))
+    self.assertEqual(result.index, 3)
+    [(event, filename, data, path)] = result.events
+    self.assertEqual((event, filename), ('save', 'out-a-2.stl'))
+    self.assertTrue(data)
+    self.assertEqual(path, ['iterate', '0', 'branch', '1', 'iterate', '2', 'save_as'])
+
+  def test_shared_meshes(self):
+    meshes = transport.SharedMeshes()
+    jobs: list[farm.Job] = []
+    env = farm.ExecutorEnvCoordinator(jobs.append, meshes)
+    asyncio.run(Context(executor, env=env).process(CONFIG))
+    self.assertIsInstance(jobs[0].state['shape'][0], transport.SharedArray)
+    # both branches of an iteration share one base mesh
+    self.assertEqual(jobs[0].state['shape'], jobs[1].state['shape'])
+    self.assertEqual(
+      asyncio.run(farm.run_job(jobs[3])),
+      asyncio.run(farm.run_job(farm.Job(3, meshes.inline(jobs[3].state), jobs[3].config))))
+
+    for job in jobs[:-1]:
+      meshes.release(job.index)
+    self.assertTrue(meshes.segments)
+    meshes.release(jobs[-1].index)
+    self.assertEqual(meshes.segments, {})
+
+  def test_workers(self):
+    farm.Coordinator(workers=2).run(CONFIG)
+    farmed = {name: Path('output', name).read_bytes()
+              for name in os.listdir('output')}
+    for name in farmed:
+      os.remove(f'output/{name}')
+
+    asyncio.run(Context(executor).process(CONFIG))
+    self.assertEqual(len(farmed), 8)
+    for name, data in farmed.items():
+      with self.subTest(name=name):
+        self.assertEqual(Path('output', name).read_bytes(), data)
+
+  def test_coordinator_events(self):
+    config = {
+      'base': {'box': [10, 10, 10]},
+      'print': 'start',
+      'branch': [
+        {'save_as': 'a.stl'},
+        {'load': {'box': [1, 1, 1]}, 'save_as': 'b.stl'},
+        # the same as a.stl, from another job
+        {'save_as': 'd.stl'},
+      ],
+      'then': {'load': {'box': [2, 2, 2]}, 'print': 'then', 'save_as': 'c.stl'},
+    }
+    farmed, sequential = _Record(), _Record()
+    farm.Coordinator(workers=1).run(config, farmed)
+    asyncio.run(Context(executor, env=sequential).process(config))
+    self.assertEqual(farmed.events, sequential.events)
+    self.assertEqual(
+      [event[1] for event in farmed.events],
+      ['[print] start', 'a.stl', 'b.stl', 'd.stl', '[then.0.print] then', 'c.stl'])
+    self.assertEqual(farmed.events[3], ('reference', 'd.stl', 'a.stl'))
+
+  def test_dead_workers(self):
+    class Coordinator(farm.Coordinator):
+      def spawn(self):
+        # exits without connecting
+        self.processes.append(subprocess.Popen([sys.executable, '-c', '']))
+    env = _Record()
+    Coordinator(workers=1).run(CONFIG, env)
+    self.assertEqual(len(env.events), 8)
+    self.assertTrue(all(event[0] == 'error' for event in env.events))
+
+
+class _Record(ExecutorEnvironment):
+  """Records prints, errors and the files written, in order."""
+  def __init__(self):
+    super().__init__()
+    self.events = []
+
+  async def print(self, *args):
+    self.events.append(('print', *args))
+
+  async def error(self, error: str):
+    self.events.append(('error', error))
+
+  async def get_file(self, filename: str, _: dict):
+    self.events.append(('file', filename))
+    return contextlib.nullcontext(io.BytesIO())
+
+  async def reference(self, ctx: Context, filename: str, original: str, _: dict):
+    self.events.append(('reference', filename, original))
+
+
+if __name__ == '__main__':
+  unittest.main()
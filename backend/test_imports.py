@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+HEAVY = ('numpy', 'trimesh', 'aiofiles', 'manifold3d')
+
+
+def _run(code: str):
+  return subprocess.run(
+    [sys.executable, '-c', code],
+    cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+class TestImports(unittest.TestCase):
+  def test_registry_without_geometry(self):
+    proc = _run(
+      'import sys\n'
+      'from backend.executor import executor\n'
+      'assert executor.map["base"].expects.doc and executor.map["base"].func.__doc__\n'
+      f'print(",".join(m for m in sys.modules if m.split(".")[0] in {HEAVY!r}))\n'
+    )
+    self.assertEqual(proc.stdout.strip(), '')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,64 @@
+import json
+import os
+import tempfile
+import unittest
+
+from backend import metrics
+
+
+class TestMetrics(unittest.TestCase):
+  def test_render(self):
+    registry = metrics.Registry()
+    requests = metrics.Counter(
+      'requests_total', 'Requests.', ('route',), registry=registry)
+    running = metrics.Gauge('running', 'Running.', registry=registry)
+    requests.labels('a"b').inc()
+    requests.labels('a"b').inc(2)
+    with running.track():
+      running.inc()
+    self.assertEqual(registry.render(), '\n'.join([
+      '# HELP requests_total Requests.',
+      '# TYPE requests_total counter',
+      'requests_total{route="a\\"b"} 3',
+      '# HELP running Running.',
+      '# TYPE running gauge',
+      'running 1',
+    ]) + '\n')
+
+  def test_histogram(self):
+    registry = metrics.Registry()
+    seconds = metrics.Histogram(
+      'seconds', 'Seconds.', ('op',), registry=registry, buckets=(1, 0.5))
+    for value in (0.25, 0.5, 0.75, 2):
+      seconds.labels('x').observe(value)
+    with seconds.labels('y').time():
+      pass
+    lines = registry.render().splitlines()
+    self.assertEqual(lines[2:7], [
+      'seconds_bucket{op="x",le="0.5"} 2',
+      'seconds_bucket{op="x",le="1"} 3',
+      'seconds_bucket{op="x",le="+Inf"} 4',
+      'seconds_sum{op="x"} 3.5',
+      'seconds_count{op="x"} 4',
+    ])
+    self.assertEqual(lines[7], 'seconds_bucket{op="y",le="0.5"} 1')
+
+  def test_gather(self):
+    registry = metrics.Registry()
+    requests = metrics.Counter('requests_total', 'Requests.', registry=registry)
+    running = metrics.Gauge('running', 'Running.', registry=registry)
+    requests.inc(2)
+    running.inc()
+    with tempfile.TemporaryDirectory() as tmp:
+      registry.dump(tmp)
+      # an exited worker, whose gauges no longer count
+      exited = {'requests_total': [[[], 3]], 'running': [[[], 5]]}
+      with open(os.path.join(tmp, f'{2**22 + 1}.json'), 'w') as fh:
+        json.dump(exited, fh)
+      text = registry.render(registry.gather(tmp))
+    self.assertIn('requests_total 5\n', text)
+    self.assertIn('running 1\n', text)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from backend.parser import parse
+from backend.parser import parse, tokenize
 
 class TestParser(unittest.TestCase):
   def setUp(self):
@@ -36,6 +36,33 @@ class TestParser(unittest.TestCase):
             self.assertEqual(parse(input, kwargs), expected)
         else:
           self.assertEqual(parse(input, kwargs), expected)
+  def test_tokenize(self):
+    token = tokenize(' avg( [1 ,x ], 2 )')
+    tokens = []
+    while token:
+      tokens.append((token.__class__.__name__, token.char, token.str_value))
+      token = token.next
+    self.assertEqual(tokens, [
+      ('Function', 1, 'avg('), ('ArrayStart', 6, '['), ('Number', 7, '1'),
+      ('Comma', 9, ','), ('Variable', 10, 'x'), ('ArrayEnd', 12, ']'),
+      ('Comma', 13, ','), ('Number', 15, '2'), ('CloseParen', 17, ')'),
+    ])
+    for (input, error) in [
+      ('  ', 'Unrecognized token at character (0):   '),
+      ('1 + $x ', 'Unrecognized token at character (4): $x'),
+      ('(1]', 'Expected OpenParen, got ArrayEnd'),
+      ('[(1)', 'Unclosed fArrayStart at character (0)'),
+    ]:
+      with self.subTest(input=input):
+        with self.assertRaises(AssertionError) as e:
+          tokenize(input)
+        self.assertEqual(str(e.exception), error)
+
+  def test_long_input(self):
+    n = 20_000
+    self.assertEqual(parse('[' + ', '.join(['1'] * n) + ']', {}, cache=None), [1] * n)
+    token = tokenize('(' * n + 'x' + ')' * n)
+    self.assertEqual(token.partner.char, 2 * n)
 
 if __name__ == '__main__':
   unittest.main()
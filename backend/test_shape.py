@@ -1,6 +1,12 @@
+import io
+import os
+import tempfile
 import unittest
+from unittest import mock
+from backend import metrics
 import backend.shape as shape
 
+import numpy as np
 import trimesh as tm
 
 
@@ -42,6 +48,234 @@ class TestShape(unittest.TestCase):
     for key, val in [('width', 2), ('height', 3), ('depth', 4)]:
       self.assertEqual(vol[key], val, f'Expected {key}={val}, got {vol[key]}')
 
+  def test_primitive(self):
+    for kind in shape.primitives:
+      with self.subTest(kind=kind):
+        s = shape.Shape.primitive(kind, [2, 3, 4], cache=None)
+        self.assertTrue(s.mesh.is_volume)
+        vol = s.volume.to_dict()
+        for key, val in [('width', 2), ('height', 3), ('depth', 4),
+                         ('left', 0), ('bottom', 0), ('front', 0)]:
+          self.assertAlmostEqual(vol[key], val, msg=f'Expected {key}={val}, got {vol[key]}')
+
+    s = shape.Shape.primitive('cylinder', [2, 2, 2], segments=7, cache=None)
+    self.assertEqual(len(s.mesh.vertices), 16)
+
+  def test_primitive_cache(self):
+    cache = shape.MeshCache()
+    s = shape.Shape.primitive('box', [1, 2, 3], cache=cache)
+    self.assertEqual(len(cache.cache), 1)
+    s.translate(5, 5, 5)
+    again = shape.Shape.primitive('box', [1, 2, 3], cache=cache)
+    self.assertEqual(len(cache.cache), 1)
+    self.assertEqual(again.volume.left, 0)
+    shape.Shape.primitive('box', [1, 2, 4], cache=cache)
+    self.assertEqual(len(cache.cache), 2)
+
+  def test_primitive_cache_limit(self):
+    one = shape.Shape.primitive('box', [1, 1, 1], cache=None).nbytes
+    cache = shape.MeshCache(max_bytes=2 * one)
+    for size in (1, 2, 3):
+      shape.Shape.primitive('box', [1, 1, size], cache=cache)
+    self.assertEqual(len(cache.cache), 2)
+    self.assertEqual(cache.size, 2 * one)
+    # the oldest entry went first, and using an entry keeps it
+    shape.Shape.primitive('box', [1, 1, 2], cache=cache)
+    shape.Shape.primitive('box', [1, 1, 4], cache=cache)
+    self.assertEqual([key[2] for key in cache.cache], [(1, 1, 2), (1, 1, 4)])
+
+  def test_primitive_orientation(self):
+    # input/cylinder.stl isn't a closed volume, so is left out
+    for kind, name in [('box', 'cube'), ('cone', 'cone'), ('wedge', 'wedge')]:
+      with self.subTest(kind):
+        filename = os.path.join(os.path.dirname(__file__), f'../input/{name}.stl')
+        loaded = shape.Shape.load(filename, cache=None)
+        loaded.zero()
+        size = [loaded.volume.width, loaded.volume.height, loaded.volume.depth]
+        made = shape.Shape.primitive(kind, size, cache=None)
+        made.zero()
+        self.assertAlmostEqual(made.mesh.volume, loaded.mesh.volume,
+                               delta=loaded.mesh.volume * 0.02)
+        if kind == 'wedge':
+          self.assertEqual(
+            sorted(map(tuple, np.round(made.mesh.vertices, 3))),
+            sorted(map(tuple, np.round(loaded.mesh.vertices, 3))))
+
+  def test_fingerprint(self):
+    a = shape.Shape(tm.creation.box())
+    b = shape.Shape(tm.creation.box())
+    self.assertEqual(a.fingerprint(), b.fingerprint())
+    b.translate(1, 0, 0)
+    self.assertNotEqual(a.fingerprint(), b.fingerprint())
+
+  def test_load_cache(self):
+    cache = shape.MeshCache()
+    filename = os.path.join(os.path.dirname(__file__), '../input/cube.stl')
+    s = shape.Shape.load(filename, cache=cache)
+    s.zero()
+    again = shape.Shape.load(filename, cache=cache)
+    self.assertEqual(len(cache.cache), 1)
+    self.assertEqual(again.volume.bottom, -21)
+
+  def test_load_disk_cache(self):
+    filename = os.path.join(os.path.dirname(__file__), '../input/cube.stl')
+    with tempfile.TemporaryDirectory() as tmp:
+      shape.disk_cache, previous = shape.DiskCache(tmp), shape.disk_cache
+      try:
+        first = shape.Shape.load(filename, cache=None)
+        self.assertEqual(os.listdir(tmp), [f'{first.key}.npz'])
+        second = shape.Shape.load(filename, cache=None)
+      finally:
+        shape.disk_cache = previous
+    self.assertEqual(first.fingerprint(), second.fingerprint())
+
+  def test_simplify(self):
+    cylinder = shape.Shape.primitive('cylinder', [20, 20, 10], segments=256, cache=None)
+    self.assertGreater(len(cylinder.mesh.faces), 1000)
+    simple = cylinder.copy()
+    simple.simplify(faces=200)
+    self.assertLessEqual(len(simple.mesh.faces), 200)
+    self.assertAlmostEqual(simple.mesh.volume / cylinder.mesh.volume, 1, places=1)
+    self.assertNotEqual(simple.key, cylinder.key)
+
+    coarse = cylinder.copy()
+    coarse.simplify(tolerance=0.5)
+    self.assertLess(len(coarse.mesh.faces), len(cylinder.mesh.faces))
+
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, 'cylinder.stl')
+      cylinder.mesh.export(filename)
+      cache = shape.MeshCache()
+      loaded = shape.Shape.load(filename, cache=cache, faces=200)
+      self.assertLessEqual(len(loaded.mesh.faces), 200)
+      # the original is cached as well as the simplified mesh
+      self.assertEqual(len(cache.cache), 2)
+      again = shape.Shape.load(filename, cache=cache, faces=200)
+    self.assertEqual(loaded.fingerprint(), again.fingerprint())
+
+  def test_simplify_limits(self):
+    # budgets that can't be met leave the closest mesh keeping its shape
+    for name, faces in [('base-45', 100), ('cube', 4)]:
+      with self.subTest(name):
+        filename = os.path.join(os.path.dirname(__file__), f'../input/{name}.stl')
+        original = shape.Shape.load(filename, cache=None)
+        simple = original.copy()
+        simple.simplify(faces=faces)
+        self.assertGreater(len(simple.mesh.faces), faces)
+        self.assertLessEqual(len(simple.mesh.faces), len(original.mesh.faces))
+        self.assertAlmostEqual(
+          simple.mesh.volume / original.mesh.volume, 1, delta=shape.SIMPLIFY_MAX_VOLUME_CHANGE)
+        coarse = original.copy()
+        coarse.simplify(tolerance=1000)
+        self.assertAlmostEqual(
+          coarse.mesh.volume / original.mesh.volume, 1, delta=shape.SIMPLIFY_MAX_VOLUME_CHANGE)
+
+  def test_boolean_timing(self):
+    def seconds(histogram):
+      return histogram.value()[1]
+    a = shape.Shape.primitive('cylinder', [20, 20, 20], segments=512, cache=None)
+    b = shape.Shape.primitive('cylinder', [20, 20, 20], segments=512, cache=None)
+    b.translate(5, 0, 5)
+    boolean = metrics.boolean_seconds.labels('difference')
+    before = seconds(boolean), seconds(metrics.evaluation_seconds)
+    a.subtract(b)
+    a.mesh
+    # the boolean itself is timed, rather than left for the mesh evaluation
+    self.assertGreater(seconds(boolean) - before[0],
+                       seconds(metrics.evaluation_seconds) - before[1])
+
+  def test_compact(self):
+    def build():
+      s = shape.Shape.primitive('cylinder', [2, 2, 2], segments=16, cache=None)
+      s.scale(-1, 1, 1)
+      other = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+      other.translate(-0.5, 0.5, 0.5)
+      s.subtract(other)
+      return s, other
+
+    full, full_other = build()
+    shape.compact = True
+    try:
+      narrow, narrow_other = build()
+    finally:
+      shape.compact = False
+    self.assertEqual(narrow_other._arrays[0].dtype, 'float32')
+    self.assertIsNone(narrow_other._mesh)
+    self.assertLess(narrow_other.nbytes, full_other.nbytes)
+    self.assertEqual(narrow.fingerprint(), full.fingerprint())
+    self.assertAlmostEqual(narrow.mesh.volume, full.mesh.volume)
+
+  def test_encode(self):
+    s = shape.Shape.primitive('cylinder', [2, 2, 2], segments=32, cache=None)
+    stl = s.encode()
+    for file_type in ('ply', 'glb'):
+      with self.subTest(file_type=file_type):
+        data = s.encode(file_type)
+        self.assertLess(len(data), len(stl) / 2)
+        mesh = tm.load(io.BytesIO(data), file_type=file_type, force='mesh')
+        self.assertEqual(len(mesh.faces), len(s.mesh.faces))
+
+  def test_rotate(self):
+    s = shape.Shape.primitive('box', [1, 2, 3], cache=None)
+    s.rotate([0, 0, 1], 90)
+    vol = s.volume.to_dict()
+    for key, val in [('width', 2), ('height', 1), ('depth', 3)]:
+      self.assertAlmostEqual(vol[key], val, msg=f'Expected {key}={val}, got {vol[key]}')
+
+  def test_key(self):
+    a = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+    b = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+    self.assertIsNotNone(a.key)
+    self.assertEqual(a.key, b.key)
+    a.translate(1, 0, 0)
+    self.assertNotEqual(a.key, b.key)
+    b.translate(1, 0, 0)
+    self.assertEqual(a.key, b.key)
+    self.assertIsNone(shape.Shape(tm.creation.box()).key)
+    # results computed differently aren't looked up under the same key
+    for setting, value in [
+        ('compact', not shape.compact), ('CACHE_VERSION', shape.CACHE_VERSION + 1)]:
+      with self.subTest(setting=setting):
+        with mock.patch.object(shape, setting, value):
+          c = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+        self.assertNotEqual(c.key, shape.Shape.primitive('box', [1, 1, 1], cache=None).key)
+
+  def test_disk_cache(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      cache = shape.DiskCache(tmp)
+      self.assertIsNone(cache.get('missing'))
+      box = tm.creation.box()
+      cache.set('box', box.vertices, box.faces)
+      vertices, faces = cache.get('box')
+      self.assertEqual(len(faces), 12)
+      self.assertTrue((vertices == box.vertices).all())
+
+      size = os.path.getsize(os.path.join(tmp, 'box.npz'))
+      cache = shape.DiskCache(tmp, max_bytes=size * 2)
+      cache.set('other', box.vertices, box.faces)
+      os.utime(os.path.join(tmp, 'box.npz'))
+      cache.set('third', box.vertices, box.faces)
+      self.assertEqual(sorted(os.listdir(tmp)), ['box.npz', 'third.npz'])
+
+  def test_merge_disk_cache(self):
+    def build():
+      s = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+      other = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+      other.translate(0.5, 0.5, 0.5)
+      s.merge(other)
+      return s
+
+    with tempfile.TemporaryDirectory() as tmp:
+      shape.disk_cache, previous = shape.DiskCache(tmp), shape.disk_cache
+      try:
+        first = build()
+        self.assertEqual(len(os.listdir(tmp)), 1)
+        second = build()
+      finally:
+        shape.disk_cache = previous
+      self.assertEqual(first.key, second.key)
+      self.assertEqual(first.fingerprint(), second.fingerprint())
+
   def test_merge(self):
     s = shape.Shape(tm.creation.box())
     s.zero()
@@ -72,6 +306,59 @@ class TestShape(unittest.TestCase):
         else:
           self.assertNotIn(pt, pts)
 
+  def test_pattern(self):
+    s = shape.Shape(tm.creation.box())
+    s.zero()
+    arr = s.pattern([[0, 0, 0], [2, 0, 0], [0, 0, 3]])
+    self.assertEqual(len(arr.mesh.faces), 3 * len(s.mesh.faces))
+    self.assertEqual(len(arr.mesh.vertices), 3 * len(s.mesh.vertices))
+    vol = arr.volume.to_dict()
+    for key, val in [('width', 3), ('height', 1), ('depth', 4)]:
+      self.assertEqual(vol[key], val, f'Expected {key}={val}, got {vol[key]}')
+
+    base = shape.Shape(tm.creation.box(extents=[10, 1, 10]))
+    base.zero()
+    other = shape.Shape(tm.creation.box())
+    other.zero()
+    other.translate(1, 1, 1)
+    base.merge(other.pattern([[0, 0, 0], [2, 0, 0], [4, 0, 0]]))
+    self.assertTrue(base.mesh.is_volume)
+    self.assertAlmostEqual(base.mesh.volume, 103)
+
+    # overlapping instances are unioned rather than concatenated
+    for operation, expected in [('merge', 108), ('subtract', 92)]:
+      with self.subTest(operation=operation):
+        base = shape.Shape(tm.creation.box(extents=[10, 1, 10]))
+        base.zero()
+        other = shape.Shape(tm.creation.box(extents=[2, 2, 2]))
+        other.zero()
+        getattr(base, operation)(other.pattern([[0, 0, 0], [1, 0, 0], [2, 0, 0]]))
+        self.assertTrue(base.mesh.is_volume)
+        self.assertAlmostEqual(base.mesh.volume, expected)
+
+    # matrices, here mirroring an instance
+    mirror = np.diag([-1.0, 1, 1, 1])
+    mirror[0, 3] = -1
+    arr = s.pattern([np.eye(4), mirror])
+    self.assertTrue(arr.mesh.is_volume)
+    self.assertAlmostEqual(arr.mesh.volume, 2)
+    self.assertEqual(arr.volume.to_dict()['left'], -2)
+
+  def test_consecutive_merges(self):
+    s = shape.Shape.primitive('box', [4, 1, 1], cache=None)
+    for x in range(3):
+      other = shape.Shape.primitive('box', [1, 1, 1], cache=None)
+      other.translate(x * 1.5, 1, 0)
+      s.merge(other)
+      # stays in manifold form between booleans
+      self.assertIsNone(s._mesh)
+      self.assertEqual(s.volume.height, 2)
+    s.translate(1, 0, 0)
+    self.assertIsNone(s._mesh)
+    self.assertEqual(s.volume.left, 1)
+    self.assertAlmostEqual(s.mesh.volume, 7)
+    self.assertTrue(s.mesh.is_volume)
+
   def test_subtract(self):
     s = shape.Shape(tm.creation.box())
     s.zero()
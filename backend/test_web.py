@@ -0,0 +1,145 @@
+import asyncio
+import io
+import json
+import unittest
+import zipfile
+
+from backend import metrics
+from backend.executor import Context, executor
+from backend.web import ExecutorEnvWeb, ExecutorEnvZip, app
+
+
+class TestWeb(unittest.TestCase):
+  def test_repeated_save(self):
+    config = {
+      'base': {'box': [4, 4, 4]},
+      'branch': [
+        {'load': {'box': [size] * 3}, 'attach': 'top_center', 'save_as': name}
+        for size, name in [
+          (1, 'same.stl'), (2, 'same.stl'), (3, 'same.stl'), (3, 'copy.stl')]
+      ],
+    }
+    queued = metrics.outputs_queued.value()
+
+    async def run():
+      queue = asyncio.Queue()
+      env = ExecutorEnvWeb(queue)
+      await Context(executor, env=env).process(config)
+      await env.drain()
+      self.assertEqual(env.encoding, {})
+      return [json.loads(queue.get_nowait()) for _ in range(queue.qsize())]
+    frames = asyncio.run(run())
+
+    self.assertEqual(metrics.outputs_queued.value(), queued)
+    self.assertEqual([f['name'] for f in frames if 'data' in f], ['same.stl'] * 3)
+    self.assertEqual(len({f['volume']['height'] for f in frames}), 3)
+    # the reference is sent after every output of the name it refers to
+    self.assertEqual(frames[-1]['name'], 'copy.stl')
+    self.assertEqual(frames[-1]['ref'], 'same.stl')
+
+  def test_pending(self):
+    config = {
+      'iterate': 12,
+      'base': {'box': [1, 1, {'eval': 'arg0 + 1'}]},
+      'save_as': 'a{arg0}.stl',
+    }
+    encoding = []
+
+    class Env(ExecutorEnvWeb):
+      async def save(self, ctx, filename, extra):
+        await super().save(ctx, filename, extra)
+        encoding.append(sum(len(frames) for frames in self.encoding.values()))
+
+    async def run():
+      queue = asyncio.Queue()
+      env = Env(queue, max_pending=2)
+      await Context(executor, env=env).process(config)
+      await env.drain()
+      return [json.loads(queue.get_nowait()) for _ in range(queue.qsize())]
+    frames = asyncio.run(run())
+
+    self.assertEqual(len(frames), 12)
+    self.assertLessEqual(max(encoding), 2)
+
+  def test_zip_backpressure(self):
+    # more outputs than fit in the queue, with repeats of earlier ones
+    config = {
+      'iterate': 40,
+      'base': {'box': [1, 1, {'eval': 'arg0 % 20 + 1'}]},
+      'save_as': 'f{arg0}.stl',
+    }
+
+    async def run():
+      queue = asyncio.Queue(1)
+      env = ExecutorEnvZip(queue)
+
+      async def render():
+        await Context(executor, env=env).process(config)
+        await env.close()
+      task = asyncio.create_task(render())
+      chunks = []
+      # a client reading slower than outputs are encoded
+      while (chunk := await queue.get()) is not None:
+        chunks.append(chunk)
+        await asyncio.sleep(0.002)
+      await task
+      return b''.join(chunks)
+    archive = zipfile.ZipFile(io.BytesIO(asyncio.run(run())))
+
+    self.assertIsNone(archive.testzip())
+    self.assertEqual(sorted(archive.namelist()), sorted(f'f{i}.stl' for i in range(40)))
+    self.assertEqual(archive.read('f25.stl'), archive.read('f5.stl'))
+    self.assertNotEqual(archive.read('f6.stl'), archive.read('f5.stl'))
+
+  def test_zip_disconnect(self):
+    body = json.dumps({
+      'iterate': 40,
+      'base': {'box': [1, 1, {'eval': 'arg0 + 1'}]},
+      'save_as': 'a{arg0}.stl',
+    }).encode()
+    queued = metrics.outputs_queued.value()
+
+    async def run():
+      disconnected = asyncio.Event()
+      requested = []
+      chunks = []
+
+      async def receive():
+        if not requested:
+          requested.append(body)
+          return {'type': 'http.request', 'body': body, 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+      async def send(message):
+        if message['type'] == 'http.response.body' and message.get('body'):
+          chunks.append(message['body'])
+          # read a little, then go away with the rest still to render
+          disconnected.set()
+          await asyncio.sleep(3600)
+
+      scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'POST', 'scheme': 'http', 'path': '/cgi-bin/render.zip',
+        'raw_path': b'/cgi-bin/render.zip', 'query_string': b'',
+        'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 80),
+        'extensions': {},
+      }
+      await asyncio.wait_for(app(scope, receive, send), 10)
+      for _ in range(100):
+        zipping = [t for t in asyncio.all_tasks()
+                   if t.get_coro().__name__ in ('_zip_task', '_add')]
+        if not zipping:
+          break
+        await asyncio.sleep(0.05)
+      return chunks, zipping
+    chunks, zipping = asyncio.run(run())
+
+    self.assertTrue(chunks)
+    self.assertEqual(zipping, [])
+    self.assertEqual(metrics.outputs_queued.value(), queued)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,28 @@
+import io
+import unittest
+import zipfile
+
+from backend.zipstream import ZipStream, deflate
+
+
+class TestZipStream(unittest.TestCase):
+  def test_stream(self):
+    stream = ZipStream()
+    entry = deflate(b'solid' * 100)
+    chunks = [
+      stream.add('a.stl', *entry),
+      stream.add('b.stl', *entry),
+      stream.add('empty.txt', *deflate(b'')),
+    ]
+    self.assertTrue(all(chunks))
+    chunks.append(stream.close())
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    self.assertIsNone(archive.testzip())
+    self.assertEqual(archive.namelist(), ['a.stl', 'b.stl', 'empty.txt'])
+    self.assertEqual(archive.read('a.stl'), b'solid' * 100)
+    self.assertEqual(archive.read('b.stl'), b'solid' * 100)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+"""
+Hands meshes to worker processes on the same host through shared memory, so
+that jobs carry small handles rather than pickled copies of every vertex.
+
+The coordinator owns every segment. Shapes with the same key share a segment,
+which is unlinked once the last job using it has a result (or on close).
+Workers only attach long enough to copy the arrays out, so one that dies
+strands nothing; should the coordinator itself die, its resource tracker
+unlinks what remains.
+"""
+
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+import itertools
+import threading
+
+from backend.lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# names of the segments created by this process, which remain registered
+_created: set[str] = set()
+
+
+@dataclass(frozen=True)
+class SharedArray:
+  """A handle to an array held in a shared memory segment."""
+  name: str
+  shape: tuple[int, ...]
+  dtype: str
+
+  def view(self, segment: shared_memory.SharedMemory):
+    return np.ndarray(self.shape, self.dtype, buffer=segment.buf)
+
+  def load(self):
+    """Copies the array out of its segment, from any process on this host."""
+    try:
+      segment = shared_memory.SharedMemory(self.name, track=False)
+    except TypeError:
+      # before python 3.13, attaching also registers the segment for removal
+      # when this process exits, which is only for the coordinator to do
+      segment = shared_memory.SharedMemory(self.name)
+      if self.name not in _created:
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    try:
+      view = self.view(segment)
+      array = view.copy()
+      del view
+      return array
+    finally:
+      segment.close()
+
+
+def _map_shapes(state: dict, func) -> dict:
+  """Applies `func` to the arrays of a context state's shapes."""
+  return dict(state, **{
+    name: None if state[name] is None else (
+      func(state[name][0]), func(state[name][1]), *state[name][2:])
+    for name in ('shape', 'other')
+  })
+
+
+def attach(state: dict) -> dict:
+  """Replaces the handles in a context state with their arrays."""
+  return _map_shapes(
+    state, lambda a: a.load() if isinstance(a, SharedArray) else a)
+
+
+class SharedMeshes:
+  """The coordinator's shared memory segments, counted by the jobs using them."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.segments: dict[str, shared_memory.SharedMemory] = {}
+    # shape key => handles, and number of jobs using them
+    self.handles: dict[str, tuple[SharedArray, SharedArray]] = {}
+    self.users: dict[str, int] = {}
+    # job index => shape keys it uses
+    self.jobs: dict[int, list[str]] = {}
+    self.anonymous = itertools.count()
+
+  def _create(self, array) -> SharedArray:
+    array = np.ascontiguousarray(array)
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    handle = SharedArray(segment.name, array.shape, array.dtype.str)
+    handle.view(segment)[...] = array
+    self.segments[segment.name] = segment
+    _created.add(segment.name)
+    return handle
+
+  def share(self, index: int, state: dict) -> dict:
+    """Moves a job's context state into shared memory, returning handles."""
+    with self.lock:
+      keys = self.jobs.setdefault(index, [])
+      shared = {}
+      for name in ('shape', 'other'):
+        if state[name] is None:
+          continue
+        vertices, faces, key, *rest = state[name]
+        # unkeyed shapes can't be matched, so get segments of their own
+        handle_key = key if key is not None else f'anonymous-{next(self.anonymous)}'
+        if handle_key not in self.handles:
+          self.handles[handle_key] = (self._create(vertices), self._create(faces))
+          self.users[handle_key] = 0
+        self.users[handle_key] += 1
+        keys.append(handle_key)
+        shared[name] = (*self.handles[handle_key], key, *rest)
+      return dict(state, **shared)
+
+  def inline(self, state: dict) -> dict:
+    """Copies the arrays back into a state, for workers on other hosts."""
+    with self.lock:
+      return _map_shapes(state, lambda a: a.view(self.segments[a.name]).copy()
+                         if isinstance(a, SharedArray) else a)
+
+  def release(self, index: int):
+    """Unlinks the segments no longer used by any unfinished job."""
+    with self.lock:
+      for key in self.jobs.pop(index, []):
+        self.users[key] -= 1
+        if self.users[key] == 0:
+          del self.users[key]
+          for handle in self.handles.pop(key):
+            self._unlink(handle.name)
+
+  def _unlink(self, name: str):
+    segment = self.segments.pop(name)
+    _created.discard(name)
+    segment.close()
+    segment.unlink()
+
+  def close(self):
+    with self.lock:
+      for name in list(self.segments):
+        self._unlink(name)
+      self.handles.clear()
+      self.users.clear()
+      self.jobs.clear()
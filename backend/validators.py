@@ -54,11 +54,40 @@ def and_(*validators: Validator):
 
 def or_(*validators: Validator):
   def inner(input):
-    assert any(v.test(input) for v in validators)
+    assert any(v.check(input) for v in validators)
   inner.__doc__ = f'({") or (".join(v.doc for v in validators)})'
   return Validator(inner)
 
 
+def primitive(kinds):
+  """Given a list of primitive names, returns a validator of primitive specs"""
+  kinds = sorted(kinds)
+  def inner(input):
+    map.test(input)
+    names = [k for k in input.keys() if k != 'segments']
+    assert len(names) == 1 and names[0] in kinds
+    vec3_numeric.test(input[names[0]])
+    if 'segments' in input:
+      assert type(input['segments']) == int and input['segments'] >= 3
+  inner.__doc__ = (
+    f'map of one of {json.dumps(kinds)} to a [x, y, z] size, '
+    'with optional integer "segments"')
+  return Validator(inner)
+
+
+@Validator.wrap
+def mesh_file(input):
+  """Map of "file" to a filename, optionally with a "tolerance" or integer "faces" limit"""
+  map.test(input)
+  assert type(input.get('file')) == str
+  assert set(input.keys()) in ({'file'}, {'file', 'faces'}, {'file', 'tolerance'})
+  if 'faces' in input:
+    assert type(input['faces']) == int and input['faces'] >= 4
+  if 'tolerance' in input:
+    numeric.test(input['tolerance'])
+    assert input['tolerance'] > 0
+
+
 @Validator.wrap
 def any_(input):
   """Any input"""
@@ -152,4 +181,28 @@ def commands(input):
   if type(input) == list:
     assert all(type(n) == dict for n in input)
   else:
-    assert type(input) == dict
\ No newline at end of file
+    assert type(input) == dict
+
+@Validator.wrap
+def matrix4(input):
+  """4x4 numeric matrix, as a list of rows"""
+  vec.test(input)
+  assert len(input) == 4
+  for row in input:
+    vec_numeric.test(row)
+    assert len(row) == 4 and all(numeric.check(n) for n in row)
+
+
+@Validator.wrap
+def pattern_input(input):
+  """[x, y, z] offsets or 4x4 matrices, or a map of "grid" counts and "spacing\""""
+  if type(input) == list:
+    assert input and (
+      all(vec3_numeric.check(n) for n in input)
+      or all(matrix4.check(n) for n in input))
+  else:
+    map.test(input)
+    assert set(input.keys()) == {'grid', 'spacing'}
+    vec3_numeric.test(input['grid'])
+    vec3_numeric.test(input['spacing'])
+    assert all(type(n) == int and n > 0 for n in input['grid'])
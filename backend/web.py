@@ -1,14 +1,20 @@
 from quart import Quart, send_from_directory, request
 from os import path
-import contextlib
-import io
-import yaml
+import concurrent.futures
+import os
+import typing
 import json
 import asyncio
 import base64
+import time
 import traceback
 
-from backend.executor import Context, executor, ExecutorEnvironment, AbortError
+from backend import metrics
+from backend.documents import parse_document, read_documents
+from backend.executor import (
+    Context, executor, ExecutorEnvironment, AbortError, count_outputs)
+from backend.shape import OUTPUT_FORMATS, Shape
+from backend.zipstream import ZipStream, deflate
 
 
 app = Quart(
@@ -23,10 +29,53 @@ async def serve_index():
     return await send_from_directory(app.static_folder, 'index.html')
 
 
+# Seconds between progress events while rendering.
+PROGRESS_INTERVAL = 1.0
+
+# Packages finished meshes into stream frames off of the executor's loop.
+encode_pool = concurrent.futures.ThreadPoolExecutor(
+    thread_name_prefix='encode')
+
+# Outputs each render holds while they wait to be encoded, before saving
+# waits for one to be sent.
+ENCODE_PENDING = 8
+
+
+def _encode(shape: Shape, file_type: str):
+    return base64.b64encode(shape.encode(file_type)).decode('ascii')
+
+
+def _encode_frame(shape: Shape, filename: str, extra: dict, file_type: str):
+    if file_type != 'stl':
+        extra = dict(extra, format=file_type)
+    if shape.cutouts:
+        # previews send subtracted shapes alongside, rather than applied
+        extra = dict(extra, parts=[
+            dict(role='subtract', data=_encode(cutout, file_type))
+            for cutout in shape.cutouts])
+    return json.dumps(dict(name=filename, data=_encode(shape, file_type), **extra))
+
+
 class ExecutorEnvWeb(ExecutorEnvironment):
-    def __init__(self, queue: asyncio.Queue[str]):
+    """
+    Streams events onto the queue. Outputs are sent as soon as they have been
+    encoded, tagged with the `path` that saved them, alongside `progress`
+    events counting them against the expected total. Outputs are encoded as
+    `file_type`, keeping their (.stl) names. At most `max_pending` outputs are
+    held in memory before `save` waits on the encoder.
+    """
+    def __init__(self, queue: asyncio.Queue[str|None], preview: bool = False,
+                 file_type: str = 'stl', max_pending: int = ENCODE_PENDING):
         super().__init__()
         self.queue = queue
+        self.preview = preview
+        self.file_type = file_type
+        self.pending = asyncio.Semaphore(max_pending)
+        # filename => frames being encoded, more than one if saved repeatedly
+        self.encoding: dict[str, list[asyncio.Future]] = {}
+        self.started = time.monotonic()
+        self.done = 0
+        self.total: int|None = 0
 
     async def print(self, *args):
         await self.queue.put(json.dumps({
@@ -37,62 +86,360 @@ class ExecutorEnvWeb(ExecutorEnvironment):
         await self.queue.put(json.dumps({
             'error': error
         }))
-    
-    async def get_file(self, filename: str, extra: dict):
-        @contextlib.asynccontextmanager
-        async def ctx():
-            with io.BytesIO() as fh:
-                yield fh
-                fh.seek(0)
-                await self.queue.put(json.dumps(dict(
-                    name=filename, 
-                    data=base64.b64encode(fh.read()).decode('ascii'),
-                    **extra,
-                )))
-        return ctx()
-
-
-async def _processing_task(queue: asyncio.Queue[str], config: dict|list):
+
+    def expect(self, count: int|None):
+        """Adds outputs to the expected total, which is None once unknown."""
+        if self.total is not None and count is not None:
+            self.total += count
+        else:
+            self.total = None
+
+    def progress(self):
+        elapsed = time.monotonic() - self.started
+        eta = None
+        if self.total is not None and self.done:
+            eta = elapsed / self.done * max(self.total - self.done, 0)
+        return json.dumps({'progress': dict(
+            done=self.done, total=self.total, elapsed=elapsed, eta=eta)})
+
+    def _output(self, frame: str):
+        self.done += 1
+        self.queue.put_nowait(frame)
+
+    async def save(self, ctx: Context, filename: str, extra: dict):
+        """Hands the shape to the encode pool, sending it once encoded."""
+        extra = dict(extra, path='.'.join(ctx.path))
+        await self.pending.acquire()
+        metrics.outputs_queued.inc()
+        frame = asyncio.get_running_loop().run_in_executor(
+            encode_pool, _encode_frame, ctx.shape.copy(), filename, extra,
+            self.file_type)
+        self.encoding.setdefault(filename, []).append(frame)
+
+        def encoded(_):
+            pending = self.encoding[filename]
+            pending.remove(frame)
+            if not pending:
+                del self.encoding[filename]
+            metrics.outputs_queued.dec()
+            self.pending.release()
+            try:
+                self._output(frame.result())
+            except Exception as e:
+                traceback.print_exception(e)
+                self.queue.put_nowait(json.dumps(
+                    {'error': f'Failed to encode output: {e}'}))
+        frame.add_done_callback(encoded)
+
+    async def reference(self, ctx: Context, filename: str, original: str,
+                        extra: dict):
+        frame = json.dumps(dict(
+            name=filename,
+            ref=original,
+            path='.'.join(ctx.path),
+            **extra,
+        ))
+        # references must follow the output they refer to, so wait on every
+        # pending save of that name
+        pending = list(self.encoding.get(original, ()))
+        if not pending:
+            self._output(frame)
+            return
+
+        def sent(_):
+            pending.pop()
+            if not pending:
+                self._output(frame)
+        for original_frame in list(pending):
+            original_frame.add_done_callback(sent)
+
+    async def drain(self):
+        """Waits for all outputs to be encoded and sent."""
+        while self.encoding:
+            await asyncio.wait(
+                [frame for frames in self.encoding.values() for frame in frames])
+            await asyncio.sleep(0)
+
+    async def relieve(self):
+        # over the memory budget, stop overlapping encodes with geometry
+        await self.drain()
+
+
+# Outputs being encoded for a zip download at once, and chunks buffered ahead
+# of the client, bounding the memory each download holds.
+ZIP_PENDING = 8
+ZIP_BUFFERED = 8
+
+
+def _encode_zip_entry(shape: Shape):
+    return deflate(shape.encode())
+
+
+class ExecutorEnvZip(ExecutorEnvironment):
+    """
+    Streams outputs as a zip, adding each as soon as it has been encoded and
+    deflated in the encode pool. Identical outputs are added as entries of
+    their own (deflating to the same bytes), as symlinks aren't extracted by
+    every unzip tool, and prints and errors are collected into a trailing
+    log.txt.
+    """
+    def __init__(self, queue: asyncio.Queue[bytes|None]):
+        super().__init__()
+        self.queue = queue
+        self.zip = ZipStream()
+        self.pending = asyncio.Semaphore(ZIP_PENDING)
+        # held from laying out an entry until its bytes are queued, as the zip
+        # records each entry's offset as it is added
+        self.writing = asyncio.Lock()
+        self.tasks: set[asyncio.Task] = set()
+        self.log: list[str] = []
+
+    async def print(self, *args):
+        self.log.append(' '.join(str(arg) for arg in args))
+
+    async def error(self, error: str):
+        self.log.append(f'Error: {error}')
+
+    async def save(self, ctx: Context, filename: str, _: dict):
+        await self.pending.acquire()
+        metrics.outputs_queued.inc()
+        task = asyncio.create_task(self._add(ctx.shape.copy(), filename))
+        self.tasks.add(task)
+        task.add_done_callback(self._added)
+
+    def _added(self, task: asyncio.Task):
+        # also called for tasks cancelled before they started
+        self.tasks.discard(task)
+        metrics.outputs_queued.dec()
+        self.pending.release()
+
+    async def _add(self, shape: Shape, filename: str):
+        try:
+            entry = await asyncio.get_running_loop().run_in_executor(
+                encode_pool, _encode_zip_entry, shape)
+            async with self.writing:
+                await self.queue.put(self.zip.add(filename, *entry))
+        except Exception as e:
+            traceback.print_exception(e)
+            await self.error(f'Failed to encode {filename}: {e}')
+
+    async def reference(self, ctx: Context, filename: str, original: str,
+                        extra: dict):
+        await self.save(ctx, filename, extra)
+
+    async def relieve(self):
+        await self.drain()
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    def cancel(self):
+        """Abandons the outputs being added, e.g. once the client has gone."""
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def close(self):
+        """Finishes the archive once all outputs have been added."""
+        await self.drain()
+        async with self.writing:
+            if self.log:
+                log = '\n'.join(self.log).encode() + b'\n'
+                await self.queue.put(self.zip.add('log.txt', *deflate(log)))
+            await self.queue.put(self.zip.close())
+        await self.queue.put(None)
+
+
+async def _zip_task(env: ExecutorEnvZip, body: typing.AsyncIterable[bytes]):
+    """
+    Runs each document into the zip, then ends it (unless cancelled, as
+    nothing is left to read the end).
+    """
+    try:
+        async for doc in read_documents(body):
+            try:
+                config = parse_document(doc)
+            except Exception as e:
+                await env.error(f'Failed to parse input: {e}')
+                continue
+            if config is None:
+                continue
+            try:
+                await Context(executor, env=env).process(config)
+            except AbortError:
+                await env.error('Execution halted prematurely.')
+            except Exception as e:
+                traceback.print_exception(e)
+                await env.error('A server side error occurred.')
+    except Exception as e:
+        traceback.print_exception(e)
+        await env.error(f'Failed to read input: {e}')
+    await env.close()
+
+
+async def _report_progress(env: ExecutorEnvWeb):
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        await env.queue.put(env.progress())
+
+
+async def _processing_task(queue: asyncio.Queue[str|None],
+                           body: typing.AsyncIterable[bytes],
+                           preview: bool = False, file_type: str = 'stl'):
     """
-    Run the executor, and then emit `None` to signal completion. 
+    Run the executor over each document as soon as it has been received, and
+    then emit `None` to signal completion.
     """
-    env = ExecutorEnvWeb(queue)
+    env = ExecutorEnvWeb(queue, preview, file_type)
+    reporter = asyncio.create_task(_report_progress(env))
     try:
-        await Context(executor, env=env).process(config)
-    except AbortError as e:
-        env.error('Execution halted prematurely.')
+        async for doc in read_documents(body):
+            try:
+                config = parse_document(doc)
+            except Exception as e:
+                await queue.put(json.dumps({'error': f'Failed to parse input: {e}'}))
+                continue
+            if config is None:
+                continue
+            env.expect(count_outputs(config))
+            await queue.put(env.progress())
+            try:
+                await Context(executor, env=env).process(config)
+            except AbortError as e:
+                await env.error('Execution halted prematurely.')
+            except Exception as e:
+                print(f'Unhandled {e.__class__.__name__}: {e}')
+                traceback.print_exception(e)
+                await queue.put(json.dumps({'error': 'A server side error occurred.'}))
     except Exception as e:
-        print(f'Unhandled {e.__class__.__name__}: {e}')
         traceback.print_exception(e)
-        await queue.put(json.dumps({'error': 'A server side error occurred.'}))
+        await queue.put(json.dumps({'error': f'Failed to read input: {e}'}))
     finally:
+        await env.drain()
+        reporter.cancel()
+        await queue.put(env.progress())
         await queue.put(None)  # signals shutdown
 
 
-async def _stream_renders(yml: str):
+async def _stream_renders(body: typing.AsyncIterable[bytes],
+                          preview: bool = False, file_type: str = 'stl'):
     """
     Stream events fromm the executor, rendering any STLs.
 
-    Events are single line json messages which can contain either base64
-    encoded stl files, printed debug messages, or error messages.
-    """
-    queue = asyncio.Queue[str]()
-    try:
-        config = yaml.safe_load(yml)
-    except Exception as e:
-        yield json.dumps({'error': f'Failed to parse input: {e}'})
-        return
+    The body may hold several yaml documents separated by `---`, or one json
+    config per line, each of which is run as it arrives. Events are single line
+    json messages which can contain either base64 encoded stl files, printed
+    debug messages, error messages or progress.
 
-    app.add_background_task(_processing_task, queue, config)
+    In preview mode no booleans are run: each stl holds the added parts as
+    positioned, with the subtracted parts listed under `parts`.
 
-    while True:
-        item = await queue.get()
-        if item is None:
-            break
-        yield f'{item}\n'
+    Meshes are stl unless another `file_type` is requested (e.g. the indexed
+    ply or glb), in which case messages name it under `format`.
+    """
+    queue = asyncio.Queue[str|None]()
+    app.add_background_task(_processing_task, queue, body, preview, file_type)
+
+    streamed = metrics.streamed_bytes.labels('render')
+    with (metrics.renders_in_flight.labels('render').track(),
+          metrics.render_seconds.labels('render').time()):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            # json is ascii, so characters are bytes
+            streamed.inc(len(item) + 1)
+            yield f'{item}\n'
 
 
 @app.route("/cgi-bin/render.pl", methods=['POST'])
 async def serve_render():
-    yaml_data = await request.get_data(as_text=True)
-    return _stream_renders(yaml_data)
+    file_type = request.args.get('format', 'stl')
+    if file_type not in OUTPUT_FORMATS:
+        metrics.render_requests.labels('render', '400').inc()
+        return {'error': f'Unsupported format: "{file_type}", expected one of '
+                         f'{", ".join(OUTPUT_FORMATS)}'}, 400
+    metrics.render_requests.labels('render', '200').inc()
+    return _stream_renders(request.body, 'preview' in request.args, file_type)
+
+
+async def _form_config(form):
+    yield form['config'].encode()
+
+
+@app.route("/cgi-bin/render.zip", methods=['POST'])
+async def serve_zip():
+    """
+    Renders the config in the body (or a posted form's `config` field, so a
+    browser can save the download straight to disk) as a zip of its stls.
+
+    The config is rendered again for the download, rather than the zip being
+    built from outputs a client already has: streamed outputs may be previews
+    or ply, and clients needn't hold them all to save them.
+    """
+    body = request.body
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        body = _form_config(await request.form)
+    queue = asyncio.Queue[bytes|None](ZIP_BUFFERED)
+    env = ExecutorEnvZip(queue)
+    task = asyncio.create_task(_zip_task(env, body))
+    metrics.render_requests.labels('zip', '200').inc()
+
+    async def chunks():
+        streamed = metrics.streamed_bytes.labels('zip')
+        try:
+            with (metrics.renders_in_flight.labels('zip').track(),
+                  metrics.render_seconds.labels('zip').time()):
+                while (chunk := await queue.get()) is not None:
+                    streamed.inc(len(chunk))
+                    yield chunk
+        finally:
+            # stops the render if the client disconnected, rather than
+            # leaving it waiting on the full queue
+            task.cancel()
+            env.cancel()
+    return chunks(), 200, {
+        'Content-Type': 'application/zip',
+        'Content-Disposition': 'attachment; filename="stls.zip"',
+    }
+
+
+# With several workers, each dumps its metrics into this directory every
+# METRICS_INTERVAL seconds, for whichever is scraped to report their sum.
+metrics_dir = os.environ.get('YASE_METRICS_DIR')
+METRICS_INTERVAL = 5.0
+
+
+async def _dump_metrics():
+    while True:
+        await asyncio.to_thread(metrics.registry.dump, metrics_dir)
+        await asyncio.sleep(METRICS_INTERVAL)
+
+
+@app.before_serving
+async def _start_metrics():
+    if metrics_dir is not None:
+        app.metrics_task = asyncio.create_task(_dump_metrics())
+
+
+@app.after_serving
+async def _stop_metrics():
+    if metrics_dir is not None:
+        app.metrics_task.cancel()
+
+
+def _gather_metrics():
+    metrics.registry.dump(metrics_dir)
+    return metrics.registry.render(metrics.registry.gather(metrics_dir))
+
+
+@app.route("/metrics")
+async def serve_metrics():
+    """Request, render and cache metrics, in the Prometheus text format."""
+    if metrics_dir is None:
+        text = metrics.registry.render()
+    else:
+        text = await asyncio.to_thread(_gather_metrics)
+    return text, 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+    }
@@ -0,0 +1,72 @@
+"""
+Writes a zip archive incrementally, handing back the bytes of each entry as it
+is added, so an archive can be sent while its later entries are still being
+produced. Entries are deflated by the caller (e.g. in a thread pool) with
+`deflate`, leaving only the headers to be written in order.
+"""
+
+import stat
+import time
+import zipfile
+import zlib
+
+
+def deflate(data: bytes, level: int = 6):
+  """Compresses an entry, returning (compressed, crc, size) for `ZipStream.add`."""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+
+class _Chunks:
+  """A write-only file collecting what zipfile writes, until taken."""
+  def __init__(self):
+    self.chunks: list[bytes] = []
+
+  def write(self, data) -> int:
+    self.chunks.append(bytes(data))
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def take(self) -> bytes:
+    data = b''.join(self.chunks)
+    self.chunks = []
+    return data
+
+
+class ZipStream:
+  """
+  Lays out entries with zipfile's own headers and central directory (with
+  zip64 extensions as needed), without seeking back over anything written.
+  """
+  def __init__(self):
+    self.out = _Chunks()
+    # not seekable, so zipfile tracks the offset itself
+    self.zip = zipfile.ZipFile(self.out, 'w')
+
+  def _info(self, name: str):
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.external_attr = (stat.S_IFREG | 0o644) << 16
+    return info
+
+  def _write(self, info: zipfile.ZipInfo, compressed: bytes) -> bytes:
+    info.header_offset = self.zip.fp.tell()
+    self.zip.fp.write(info.FileHeader())
+    self.zip.fp.write(compressed)
+    self.zip.filelist.append(info)
+    self.zip.NameToInfo[info.filename] = info
+    self.zip.start_dir = self.zip.fp.tell()
+    return self.out.take()
+
+  def add(self, name: str, compressed: bytes, crc: int, size: int) -> bytes:
+    """Adds an entry from the output of `deflate`, returning its bytes."""
+    info = self._info(name)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC, info.compress_size, info.file_size = crc, len(compressed), size
+    return self._write(info, compressed)
+
+  def close(self) -> bytes:
+    """Returns the central directory, ending the archive."""
+    self.zip.close()
+    return self.out.take()
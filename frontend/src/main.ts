@@ -1,15 +1,34 @@
-import * as zip from "@zip.js/zip.js";
-
 import {Editor} from './editor.js';
-import {Viewer, StlGeometry, base64toUint8} from './viewer.js';
+import {Viewer, StlGeometry, StlPart, MeshFormat, toStl} from './viewer.js';
+
+// Streamed as indexed ply, which is converted back to stl for downloads.
+const STREAM_FORMAT: MeshFormat = 'ply';
 
 interface StlMessage  {
   data: string;
   name: string;
   volume: StlGeometry;
+  format?: MeshFormat;
+  // previews only: parts to be subtracted, left unapplied
+  parts?: StlPart[];
+}
+
+// An output identical to a previously sent one, referenced by name.
+interface RefMessage {
+  ref: string;
+  name: string;
+  volume: StlGeometry;
+}
+
+interface ProgressMessage {
+  done: number;
+  total: number | null;
+  elapsed: number;
+  eta: number | null;
 }
 
 const STL_CACHE: StlMessage[] = [];
+let PROGRESS_EL: HTMLElement | undefined;
 let VIEWER: Viewer;
 let EDITOR: Editor;
 
@@ -46,6 +65,13 @@ document.addEventListener('DOMContentLoaded', () => {
       render(EDITOR.getText(), VIEWER);
       return true;
     },
+  }, {
+    key: 'Mod-p',
+    preventDefault: true,
+    run: ()  => {
+      render(EDITOR.getText(), VIEWER, true);
+      return true;
+    },
   }, {
     key: 'Mod-Shift-s',
     preventDefault: true,
@@ -70,12 +96,15 @@ document.addEventListener('DOMContentLoaded', () => {
       const size = STL_CACHE.length-1;
       throw Error(`Failed to load from cache: id=${id}; cache: ${size}`);
     }
-    VIEWER.load(stl.data, stl.volume);
+    VIEWER.load(stl.data, stl.volume, stl.parts, stl.format);
   });
 
   findEl('#render_btn').addEventListener('click', async () => {
     await render(EDITOR.getText(), VIEWER);
   });
+  findEl('#preview_btn').addEventListener('click', async () => {
+    await render(EDITOR.getText(), VIEWER, true);
+  });
   for (const el of Array.from(document.querySelectorAll('.left.btn'))) {
     el.addEventListener('click', switchTab);
   }
@@ -97,9 +126,13 @@ document.addEventListener('DOMContentLoaded', () => {
   })
 });
 
-async function render(ymlSrc, viewer: Viewer) {
+async function render(ymlSrc, viewer: Viewer, preview = false) {
   removeChildren(LOGS_EL);
-  const res = await fetch('/cgi-bin/render.pl', {
+  const params = new URLSearchParams({format: STREAM_FORMAT});
+  if (preview) {
+    params.set('preview', '');
+  }
+  const res = await fetch(`/cgi-bin/render.pl?${params}`, {
     method: "POST",
     body: ymlSrc,
   });
@@ -128,10 +161,22 @@ async function processMessage(line: string, viewer: Viewer) {
     console.error(`Failed to decode message: ${e}`);
     console.log(line);
   }
+  if ('ref' in message) {
+    const ref = message as RefMessage;
+    // the latest output of that name, as a name can be saved more than once
+    const original = [...STL_CACHE].reverse().find(stl => stl.name === ref.ref);
+    if (original === undefined) {
+      console.error(`Unknown output reference: ${ref.ref}`);
+      return;
+    }
+    message = {
+      name: ref.name, data: original.data, volume: ref.volume,
+      parts: original.parts, format: original.format};
+  }
   if ('data' in message) {
     const stl = message as StlMessage;
     if (STL_CACHE.length === 0) {
-      viewer.load(stl.data, stl.volume);
+      viewer.load(stl.data, stl.volume, stl.parts, stl.format);
       removeChildren(SELECT_EL);
     }
     const option = document.createElement('option');
@@ -139,6 +184,8 @@ async function processMessage(line: string, viewer: Viewer) {
     option.value = STL_CACHE.length.toString();
     SELECT_EL.appendChild(option)
     STL_CACHE.push(stl);
+  } else if ('progress' in message) {
+    showProgress(message.progress as ProgressMessage);
   } else if ('log' in message) {
     log(message.log);
   } else if ('error' in message) {
@@ -148,6 +195,19 @@ async function processMessage(line: string, viewer: Viewer) {
   }
 }
 
+function showProgress(progress: ProgressMessage) {
+  if (PROGRESS_EL === undefined || !LOGS_EL.contains(PROGRESS_EL)) {
+    PROGRESS_EL = document.createElement('li');
+    PROGRESS_EL.classList.add('progress');
+    LOGS_EL.appendChild(PROGRESS_EL);
+  }
+  let msg = `${progress.done} / ${progress.total ?? '?'} outputs`;
+  if (progress.eta !== null && progress.done !== progress.total) {
+    msg += ` (about ${Math.ceil(progress.eta)}s remaining)`;
+  }
+  PROGRESS_EL.innerText = msg;
+}
+
 function log(msg: string, cls?: string) {
     const li = document.createElement('li');
     if (cls !== undefined) {
@@ -181,7 +241,7 @@ function switchTab(e: Event) {
 function saveStl() {
   const stl = STL_CACHE[parseInt(SELECT_EL.value)];
   const blob = new Blob(
-    [base64toUint8(stl.data).buffer as ArrayBuffer],
+    [toStl(stl.data, stl.format) as Uint8Array<ArrayBuffer>],
     {type: 'application/octet-stream'}
   );
   saveFile(stl.name, blob);
@@ -198,12 +258,18 @@ function saveFile(name: string, blob: Blob) {
   URL.revokeObjectURL(url); // Clean up the URL object
 }
 
-async function saveAllStls() {
-  const zipfile = new zip.ZipWriter(new zip.BlobWriter("application/zip"), { bufferedWrite: true });
-
-  for (const stl of STL_CACHE) {
-    await zipfile.add(stl.name, new zip.Uint8ArrayReader(base64toUint8(stl.data)));
-  }
-  const blob = await zipfile.close();
-  saveFile('stls.zip', blob);
+// Renders the config again server side as a zip, posted as a form so that the
+// browser streams the download to disk rather than holding it in memory.
+function saveAllStls() {
+  const form = document.createElement('form');
+  form.method = 'POST';
+  form.action = '/cgi-bin/render.zip';
+  form.style.display = 'none';
+  const config = document.createElement('textarea');
+  config.name = 'config';
+  config.value = EDITOR.getText();
+  form.appendChild(config);
+  document.body.appendChild(form);
+  form.submit();
+  document.body.removeChild(form);
 }
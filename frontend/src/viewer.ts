@@ -1,5 +1,7 @@
 import * as THREE from 'three';
 import { STLLoader } from 'three/examples/jsm/loaders/STLLoader.js'
+import { PLYLoader } from 'three/examples/jsm/loaders/PLYLoader.js';
+import { STLExporter } from 'three/examples/jsm/exporters/STLExporter.js';
 import { OrbitControls } from 'three/addons/controls/OrbitControls.js';
 
 
@@ -20,13 +22,48 @@ export interface StlGeometry {
   mid_z: number,
 }
 
+// A separately drawn part of a preview, such as a shape to be subtracted.
+export interface StlPart {
+  role: 'subtract';
+  data: string;
+}
+
+// Formats meshes may be streamed in, stl unless otherwise named.
+export type MeshFormat = 'stl' | 'ply';
+
+const stlLoader = new STLLoader();
+const plyLoader = new PLYLoader();
+
+export function parseGeometry(data: string, format: MeshFormat = 'stl') {
+  const buffer = base64toUint8(data).buffer;
+  if (format === 'stl') {
+    return stlLoader.parse(buffer);
+  }
+  // flat shaded like an stl, rather than smoothing across shared vertices
+  const geometry = plyLoader.parse(buffer).toNonIndexed();
+  geometry.computeVertexNormals();
+  return geometry;
+}
+
+// Binary stl contents of a streamed mesh, for downloads.
+export function toStl(data: string, format: MeshFormat = 'stl'): Uint8Array {
+  if (format === 'stl') {
+    return base64toUint8(data);
+  }
+  const mesh = new THREE.Mesh(parseGeometry(data, format));
+  const view = new STLExporter().parse(mesh, {binary: true}) as DataView;
+  mesh.geometry.dispose();
+  return new Uint8Array(view.buffer, view.byteOffset, view.byteLength);
+}
+
 export class Viewer {
   scene: THREE.Scene;
   geometry: THREE.BufferGeometry;
-  loader: STLLoader;
   renderer: THREE.WebGLRenderer;
   material: THREE.Material;
   mesh: THREE.Mesh;
+  subtractMaterial: THREE.Material;
+  parts: THREE.Mesh[] = [];
 
   camera: THREE.Camera;
   cameraTarget: THREE.Vector3;
@@ -38,8 +75,6 @@ export class Viewer {
   stlGeo: StlGeometry;
 
   constructor(el: HTMLElement) {
-    this.loader = new STLLoader();
-
     const rect = el.getBoundingClientRect();
     this.renderer = new THREE.WebGLRenderer();
     this.renderer.setSize(rect.width, rect.height);
@@ -65,6 +100,8 @@ export class Viewer {
     // const material = new THREE.MeshBasicMaterial({ color: 0x00ff00 });
     // this.material = new THREE.MeshStandardMaterial({color: 0xffa500})
     this.material = new THREE.MeshPhysicalMaterial({ color: 0xffa500 });
+    this.subtractMaterial = new THREE.MeshPhysicalMaterial({
+      color: 0xff3030, transparent: true, opacity: 0.4, depthWrite: false });
 
     this.mesh = new THREE.Mesh(this.geometry, this.material);
     this.scene.add(this.mesh);
@@ -100,14 +137,20 @@ export class Viewer {
     this.renderer.setAnimationLoop(animate);
   }
 
-  load(stl: string, geo: StlGeometry) {
+  load(stl: string, geo: StlGeometry, parts: StlPart[] = [],
+       format: MeshFormat = 'stl') {
     this.scene.remove(this.mesh);
     this.geometry.dispose();
+    for (const part of this.parts) {
+      this.scene.remove(part);
+      part.geometry.dispose();
+    }
+    this.parts = parts.map(part => new THREE.Mesh(
+      parseGeometry(part.data, format), this.subtractMaterial));
+    this.parts.forEach(part => this.scene.add(part));
 
     this.stlGeo = geo;
-    // I hate this method but I spent way too long trying to figure this out
-    const bytes = base64toUint8(stl);
-    this.geometry = this.loader.parse(bytes.buffer);
+    this.geometry = parseGeometry(stl, format);
     this.mesh = new THREE.Mesh(this.geometry, this.material);
     this.scene.add(this.mesh);
     this.resetCamera();
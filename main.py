@@ -2,22 +2,170 @@
 
 # Modified from https://pypi.org/project/numpy-stl/#combining-multiple-stl-files
 
+import os
 import sys
 import yaml
 import shutil
 import re
+import tempfile
 import asyncio
+import concurrent.futures
+import contextlib
+import time
+import traceback
 
-from backend.executor import Context, AbortError, executor
+from backend.documents import parse_document, read_documents
+from backend.executor import Context, AbortError, executor, ExecutorEnvCli
 
 
-def main(config_file: str):
+async def _read_chunks(fp, size: int = 1 << 16):
+  while chunk := await asyncio.to_thread(fp.read, size):
+    yield chunk
+
+
+async def run(config_file: str, env: ExecutorEnvCli|None = None):
+  """
+  Runs each document in the config file (or stdin, given `-`) as soon as it has
+  been read. Returns False if any document failed to parse or was aborted.
+  """
+  env = env or ExecutorEnvCli()
+  ok = True
+  try:
+    with (contextlib.nullcontext(sys.stdin) if config_file == '-'
+          else open(config_file, 'r')) as fp:
+      async for doc in read_documents(_read_chunks(fp)):
+        try:
+          config = parse_document(doc)
+        except Exception as e:
+          await env.error(f'Failed to parse input: {e}')
+          ok = False
+          continue
+        if config is None:
+          continue
+        try:
+          await Context(executor, env=env).process(config)
+        except AbortError:
+          ok = False
+  finally:
+    await env.close()
+  return ok
+
+
+def _config_files(paths: tuple[str]):
+  """Expands directories into the yaml files they contain."""
+  for path in paths:
+    if os.path.isdir(path):
+      yield from sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.endswith(('.yml', '.yaml')))
+    else:
+      yield path
+
+
+def main(*paths: str):
+  """
+  Runs each config in turn within this process, sharing the mesh and
+  expression caches and the output encoding pool. Given more than one config,
+  ends with a summary of each.
+  """
+  summary = []
+  with concurrent.futures.ThreadPoolExecutor() as pool:
+    for config_file in _config_files(paths):
+      start = time.perf_counter()
+      env = ExecutorEnvCli(pool=pool)
+      try:
+        status = 'ok' if asyncio.run(run(config_file, env)) else 'aborted'
+      except Exception as e:
+        traceback.print_exception(e)
+        status = 'failed'
+      summary.append((config_file, status, time.perf_counter() - start, env.stats))
+
+  if len(summary) > 1:
+    width = max(len(row[0]) for row in summary)
+    print()
+    for config_file, status, elapsed, stats in summary:
+      # peak memory is only measured under a YASE_MEMORY_MB budget
+      peak = (f', {stats["peak_bytes"] / 2**20:.1f} MB peak mesh memory'
+              if stats['peak_bytes'] else '')
+      print(f'{config_file:{width}}  {status:7}  {elapsed:7.2f}s  '
+            f'{stats["outputs"]} outputs, {stats["references"]} references, '
+            f'{stats["errors"]} errors{peak}')
+  if any(row[1] == 'failed' for row in summary):
+    sys.exit(1)
+
+def _address(address: str):
+  host, port = address.rsplit(':', 1)
+  return (host, int(port))
+
+
+def coordinator(config_file: str, *args: str):
+  """
+  main.py --coordinator <config> [--workers N] [--bind host:port] [--timeout S]
+
+  Spawns N local workers (default: one per cpu). With --bind, workers on other
+  hosts may connect using `main.py --worker host:port`, given the same
+  YASE_FARM_AUTHKEY (hex) environment variable. With --timeout, a job taking
+  a worker more than S seconds is retried on another.
+  """
+  from backend import farm
+  opts = dict(zip(args[::2], args[1::2]))
   with open(config_file, 'r') as fp:
     config = yaml.safe_load(fp)
+  authkey = os.environ.get(farm.AUTHKEY_ENV)
+  coord = farm.Coordinator(
+    address=_address(opts.get('--bind', '127.0.0.1:0')),
+    workers=int(opts.get('--workers', os.cpu_count() or 1)),
+    authkey=None if authkey is None else bytes.fromhex(authkey),
+    timeout=float(opts['--timeout']) if '--timeout' in opts else None,
+  )
+  if '--bind' in opts:
+    print('Accepting workers on {}:{}'.format(*coord.address))
+  coord.run(config)
+
+
+def serve(*args: str):
+  """
+  main.py --serve [--workers N] [--bind host:port] [--keep-alive S]
+                  [--certfile F --keyfile F]
+
+  Serves the web app with Hypercorn across N worker processes (default: one
+  per cpu), restarting any that die. HTTP/2 is negotiated over TLS when given a
+  certificate, otherwise to clients speaking h2c with prior knowledge (the
+  pinned h2 breaks Hypercorn's Upgrade handshake). Workers share loaded meshes
+  and boolean results through the disk cache, which defaults to yase/ in the
+  user's cache directory ($XDG_CACHE_HOME, or ~/.cache) when YASE_CACHE_DIR is
+  unset. Its entries are trusted, so it shouldn't be writable by other users.
+
+  Metrics are served from /metrics, summed across workers through a temporary
+  directory.
+  """
+  from hypercorn.config import Config
+  from hypercorn.run import run as run_server
+  opts = dict(zip(args[::2], args[1::2]))
+  # inherited by the (spawned) workers before they import the backend
+  os.environ.setdefault('YASE_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'yase'))
+  config = Config()
+  config.application_path = 'backend.web:app'
+  config.bind = [opts.get('--bind', '127.0.0.1:5000')]
+  config.workers = int(opts.get('--workers', os.cpu_count() or 1))
+  metrics_dir = None
+  if config.workers > 1:
+    metrics_dir = os.environ['YASE_METRICS_DIR'] = tempfile.mkdtemp(
+      prefix='yase-metrics-')
+  config.keep_alive_timeout = float(opts.get('--keep-alive', 5))
+  config.certfile = opts.get('--certfile')
+  config.keyfile = opts.get('--keyfile')
+  config.accesslog = '-'
+  print(f'Serving on {config.bind[0]} with {config.workers} workers, '
+        f'caching in {os.environ["YASE_CACHE_DIR"]}')
   try:
-    asyncio.run(Context(executor).process(config))
-  except AbortError:
-    pass
+    code = run_server(config)
+  finally:
+    if metrics_dir is not None:
+      shutil.rmtree(metrics_dir, ignore_errors=True)
+  sys.exit(code)
+
 
 def help(*args: str):
   try:
@@ -71,5 +219,12 @@ if __name__ == '__main__':
   elif sys.argv[1] == '--web':
     from backend.web import app
     app.run()
+  elif sys.argv[1] == '--serve':
+    serve(*sys.argv[2:])
+  elif sys.argv[1] == '--coordinator':
+    coordinator(*sys.argv[2:])
+  elif sys.argv[1] == '--worker':
+    from backend import farm
+    farm.work(_address(sys.argv[2]), bytes.fromhex(os.environ[farm.AUTHKEY_ENV]))
   else:
-    main(sys.argv[1])
+    main(*sys.argv[1:])
@@ -1,7 +1,14 @@
 import unittest
 
+from backend.test_documents import TestDocuments
+from backend.test_executor import TestExecutor
+from backend.test_farm import TestFarm
+from backend.test_imports import TestImports
+from backend.test_metrics import TestMetrics
 from backend.test_parser import TestParser
 from backend.test_shape import TestShape
+from backend.test_web import TestWeb
+from backend.test_zipstream import TestZipStream
 
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file